@@ -0,0 +1,109 @@
+import bisect, io, json, os, queue, threading, time
+import chess, chess.pgn
+from match import *
+
+RESULTS = {"White": "1-0", "Black": "0-1", "Draw": "1/2-1/2"}
+
+class GameArchive():
+    '''Append-only archive of finished games
+    games.ndjson holds one compact record per game, players.idx one "pid offset end-time" line per player per game,
+    so a player's games are found without scanning the archive. Writes happen on a background thread.
+    peers are the archive directories of other processes, see shards.py. Their games are read, never written.'''
+    def __init__(self, directory='archive', peers=()):
+        os.makedirs(directory, exist_ok=True)
+        self.data_path = os.path.join(directory, 'games.ndjson')
+        self.index_path = os.path.join(directory, 'players.idx')
+        self.sources = [self.data_path] + [os.path.join(peer, 'games.ndjson') for peer in peers]
+        self.peer_indexes = [[os.path.join(peer, 'players.idx'), 0] for peer in peers] # [path, bytes read so far]
+        self.offsets = {} # pid -> (end time, source, offset) of their games in the sources' games.ndjson, oldest first
+        self.lock = threading.Lock()
+        self.read_index(self.index_path, 0, 0)
+        self.queue = queue.Queue()
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+
+    def add(self, match, winner, reason):
+        '''Queue a finished match for archiving. Returns at once'''
+        d = match.to_dict()
+        self.queue.put({"white": d["white"], "black": d["black"], "fen": d["fen"], "moves": d["moves"],
+                        "result": RESULTS[winner], "termination": reason, "started": match.started, "ended": time.time()})
+
+    def write_loop(self):
+        with open(self.data_path, "ab") as data, open(self.index_path, "a") as index:
+            while 1:
+                record = self.queue.get()
+                if record is None:
+                    break
+                offset = data.tell()
+                data.write(json.dumps(record, separators=(',', ':')).encode("utf-8") + b"\n")
+                pids = set(p for p in (record["white"][0], record["black"][0]) if p != None)
+                index.write("".join("{} {} {}\n".format(pid, offset, record["ended"]) for pid in pids))
+                for f in (data, index):
+                    f.flush()
+                    if self.queue.empty():
+                        # fsync once per burst rather than per game
+                        os.fsync(f.fileno())
+                with self.lock:
+                    for pid in pids:
+                        bisect.insort(self.offsets.setdefault(pid, []), (record["ended"], 0, offset))
+
+    def read_index(self, path, source, start):
+        '''Index the lines of path from byte start on and return where reading stopped. A torn last line waits for the next read'''
+        if not os.path.exists(path):
+            return start
+        with open(path, "rb") as f:
+            f.seek(start)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                start += len(line)
+                parts = line.split()
+                if len(parts) in (2, 3):
+                    # Lines written before end times were indexed sort first
+                    ended = float(parts[2]) if len(parts) == 3 else 0
+                    bisect.insort(self.offsets.setdefault(int(parts[0]), []), (ended, source, int(parts[1])))
+        return start
+
+    def refresh(self):
+        '''Index the games peers have archived since the last look'''
+        with self.lock:
+            for i, peer in enumerate(self.peer_indexes):
+                peer[1] = self.read_index(peer[0], i + 1, peer[1])
+
+    def count(self, pid):
+        self.refresh()
+        with self.lock:
+            return len(self.offsets.get(pid, ()))
+
+    def recent(self, pid, start, n):
+        '''Up to n of the player's games, most recent first, skipping the start most recent ones'''
+        self.refresh()
+        with self.lock:
+            offsets = self.offsets.get(pid, [])
+            offsets = offsets[max(len(offsets) - start - n, 0):max(len(offsets) - start, 0)][::-1]
+        records = []
+        for ended, source, offset in offsets:
+            with open(self.sources[source], "rb") as f:
+                f.seek(offset)
+                records.append(json.loads(f.readline()))
+        return records
+
+    def pgn(self, record):
+        '''Render an archived game as PGN text'''
+        board = chess.Board(record["fen"] or chess.STARTING_FEN)
+        for move in unpack_moves(record["moves"]):
+            board.push(move)
+        game = chess.pgn.Game.from_board(board)
+        game.headers["Event"] = "@tgchessbot game"
+        game.headers["Site"] = "Telegram"
+        game.headers["Date"] = time.strftime("%Y.%m.%d", time.gmtime(record["started"]))
+        game.headers["White"] = str(record["white"][1])
+        game.headers["Black"] = str(record["black"][1])
+        game.headers["Result"] = record["result"]
+        game.headers["Termination"] = record["termination"]
+        return str(game) + "\n"
+
+    def close(self):
+        '''Write out everything queued and stop the writer'''
+        self.queue.put(None)
+        self.writer.join()
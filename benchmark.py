@@ -0,0 +1,93 @@
+'''Micro-benchmarks for @tgchessbot
+
+Run with `python3 benchmark.py`. Timings are per rendered position, or per parsed move, averaged over a full game.
+'''
+import time
+import chess
+from renderer import *
+from match import Match
+
+# Kasparov vs Topalov, Wijk aan Zee 1999
+GAME = '''e4 d6 d4 Nf6 Nc3 g6 Be3 Bg7 Qd2 c6 f3 b5 Nge2 Nbd7 Bh6 Bxh6 Qxh6 Bb7 a3 e5 O-O-O Qe7 Kb1 a6 Nc1 O-O-O
+Nb3 exd4 Rxd4 c5 Rd1 Nb6 g3 Kb8 Na5 Ba8 Bh3 d5 Qf4+ Ka7 Rhe1 d4 Nd5 Nbxd5 exd5 Qd6 Rxd4 cxd4 Re7+ Kb6
+Qxd4+ Kxa5 b4+ Ka4 Qc3 Qxd5 Ra7 Bb7 Rxb7 Qc4 Qxf6 Kxa3 Qxa6+ Kxb4 c3+ Kxc3 Qa1+ Kd2 Qb2+ Kd1 Bf1 Rd2
+Rd7 Rxd7 Bxc4 bxc4 Qxh8 Rd3 Qa8 c3 Qa4+ Ke1 f4 f5 Kc1 Rd2 Qa7'''.split()
+
+def positions():
+    '''Board FEN and side to move after every half-move of GAME'''
+    board = chess.Board()
+    result = [(board.board_fen(), board.turn)]
+    for san in GAME:
+        board.push_san(san)
+        result.append((board.board_fen(), board.turn))
+    return result
+
+def bench(label, render, positions, repeat=20):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        render(positions)
+    elapsed = (time.perf_counter() - start) / (repeat * len(positions))
+    print('{:<28} {:8.1f} us/position'.format(label, elapsed * 1e6))
+    return elapsed
+
+def full(positions, encode=False):
+    for fen, turn in positions:
+        img = Renderer(turn).draw_fen(fen)
+        if encode: encode_jpeg(img)
+
+def incremental(positions, encode=False):
+    frames = IncrementalRenderer()
+    for fen, turn in positions:
+        img = frames.draw_fen(fen, turn)
+        if encode: encode_jpeg(img)
+
+def table_parse(board, m):
+    '''How moves were parsed before: a table of every spelling of every legal move, built per position'''
+    table = {}
+    for move in board.legal_moves:
+        san = board.san(move)
+        for spelling in (san, san.rstrip('+#')):
+            table[spelling] = move
+            table[spelling.replace('O', '0')] = move
+        table[move.uci()] = move
+    return table.get(m)
+
+def match_parse(board, m, match=Match(0)):
+    match.board, match.moves_table = board, None
+    return match.parse_move(m)
+
+def bench_parse(label, parse, repeat=20):
+    '''Time only the parsing of each move of GAME, sent as its SAN'''
+    elapsed = 0
+    for _ in range(repeat):
+        board = chess.Board()
+        for san in GAME:
+            start = time.perf_counter()
+            move = parse(board, san)
+            elapsed += time.perf_counter() - start
+            board.push(move)
+    elapsed /= repeat * len(GAME)
+    print('{:<28} {:8.1f} us/move'.format(label, elapsed * 1e6))
+    return elapsed
+
+def check(positions):
+    '''Incremental frames must match full redraws pixel for pixel'''
+    frames = IncrementalRenderer()
+    for fen, turn in positions:
+        assert frames.draw_fen(fen, turn).tobytes() == Renderer(turn).draw_fen(fen).tobytes(), fen
+
+if __name__ == '__main__':
+    get_assets()
+    ps = positions()
+    check(ps)
+    print('Rendering {} positions'.format(len(ps)))
+    a = bench('full redraw', full, ps)
+    b = bench('incremental', incremental, ps)
+    print('speedup: {:.1f}x'.format(a / b))
+    a = bench('full redraw + JPEG', lambda ps: full(ps, True), ps)
+    b = bench('incremental + JPEG', lambda ps: incremental(ps, True), ps)
+    print('speedup: {:.1f}x'.format(a / b))
+    print('Parsing {} moves'.format(len(GAME)))
+    a = bench_parse('legal-move table', table_parse)
+    b = bench_parse('parse_move', match_parse)
+    print('speedup: {:.1f}x'.format(a / b))
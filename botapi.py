@@ -0,0 +1,18 @@
+import urllib3
+import telepot, telepot.api
+
+class BotAPI(telepot.Bot):
+    '''A telepot.Bot that talks to the Bot API at base_url instead of api.telegram.org
+    For a self-hosted Bot API server, or the stand-in one in fakeapi.py. telepot's own URL is
+    a module-wide setting, so this client keeps its own connection pool.'''
+    def __init__(self, token, base_url, pool_size=10, timeout=30):
+        super(BotAPI, self).__init__(token)
+        self.base_url = base_url.rstrip("/")
+        self.pool = urllib3.PoolManager(maxsize = pool_size, retries = 3, timeout = timeout)
+
+    def _api_request(self, method, params=None, files=None, **kwargs):
+        req = (self._token, method, params, files)
+        fields = telepot.api._compose_fields(req)
+        kwargs = telepot.api._compose_kwargs(req, **kwargs)
+        url = "{}/bot{}/{}".format(self.base_url, self._token, method)
+        return telepot.api._parse(self.pool.request_encode_body("POST", url, fields, **kwargs))
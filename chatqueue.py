@@ -0,0 +1,31 @@
+import asyncio, logging
+from collections import deque
+
+class ChatSerializer():
+    '''Runs update handlers concurrently across chats, but strictly one at a time and in arrival order within a chat'''
+    def __init__(self):
+        self.queues = {} # key -> deque of pending (handler, msg), only while the key has work
+
+    def submit(self, key, handler, msg):
+        '''Queue handler(msg) behind everything already queued under key'''
+        queue = self.queues.get(key)
+        if queue is None:
+            queue = self.queues[key] = deque()
+            queue.append((handler, msg))
+            asyncio.ensure_future(self.drain(key, queue))
+        else:
+            queue.append((handler, msg))
+
+    async def drain(self, key, queue):
+        '''Handle key's updates one by one, then forget the key'''
+        while queue:
+            handler, msg = queue.popleft()
+            try:
+                await handler(msg)
+            except Exception:
+                logging.getLogger("tgchessbot").exception("Update handler failed")
+        del self.queues[key]
+
+    def pending(self):
+        '''Number of updates waiting or being handled'''
+        return sum(len(q) for q in self.queues.values())
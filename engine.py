@@ -0,0 +1,269 @@
+import asyncio, time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import chess, chess.polyglot
+
+ENGINE_ID = 0 # Player id of the built-in engine. Telegram never hands out 0 to a user
+ENGINE_NAME = "tgchessbot"
+
+MATE = 100000
+INF = MATE + 1
+EXACT, LOWER, UPPER = 0, 1, 2 # Kinds of transposition table scores
+
+PIECE_VALUES = {chess.PAWN: 100, chess.KNIGHT: 320, chess.BISHOP: 330, chess.ROOK: 500, chess.QUEEN: 900, chess.KING: 0}
+
+# Piece-square bonuses from White's point of view, rank 8 first, so White's square s is at s ^ 56 and Black's at s
+PIECE_SQUARES = {
+    chess.PAWN: [0,  0,  0,  0,  0,  0,  0,  0,
+                 50, 50, 50, 50, 50, 50, 50, 50,
+                 10, 10, 20, 30, 30, 20, 10, 10,
+                 5,  5, 10, 25, 25, 10,  5,  5,
+                 0,  0,  0, 20, 20,  0,  0,  0,
+                 5, -5,-10,  0,  0,-10, -5,  5,
+                 5, 10, 10,-20,-20, 10, 10,  5,
+                 0,  0,  0,  0,  0,  0,  0,  0],
+    chess.KNIGHT: [-50,-40,-30,-30,-30,-30,-40,-50,
+                   -40,-20,  0,  0,  0,  0,-20,-40,
+                   -30,  0, 10, 15, 15, 10,  0,-30,
+                   -30,  5, 15, 20, 20, 15,  5,-30,
+                   -30,  0, 15, 20, 20, 15,  0,-30,
+                   -30,  5, 10, 15, 15, 10,  5,-30,
+                   -40,-20,  0,  5,  5,  0,-20,-40,
+                   -50,-40,-30,-30,-30,-30,-40,-50],
+    chess.BISHOP: [-20,-10,-10,-10,-10,-10,-10,-20,
+                   -10,  0,  0,  0,  0,  0,  0,-10,
+                   -10,  0,  5, 10, 10,  5,  0,-10,
+                   -10,  5,  5, 10, 10,  5,  5,-10,
+                   -10,  0, 10, 10, 10, 10,  0,-10,
+                   -10, 10, 10, 10, 10, 10, 10,-10,
+                   -10,  5,  0,  0,  0,  0,  5,-10,
+                   -20,-10,-10,-10,-10,-10,-10,-20],
+    chess.ROOK: [0,  0,  0,  0,  0,  0,  0,  0,
+                 5, 10, 10, 10, 10, 10, 10,  5,
+                 -5,  0,  0,  0,  0,  0,  0, -5,
+                 -5,  0,  0,  0,  0,  0,  0, -5,
+                 -5,  0,  0,  0,  0,  0,  0, -5,
+                 -5,  0,  0,  0,  0,  0,  0, -5,
+                 -5,  0,  0,  0,  0,  0,  0, -5,
+                 0,  0,  0,  5,  5,  0,  0,  0],
+    chess.QUEEN: [0] * 64,
+    chess.KING: [-30,-40,-40,-50,-50,-40,-40,-30,
+                 -30,-40,-40,-50,-50,-40,-40,-30,
+                 -30,-40,-40,-50,-50,-40,-40,-30,
+                 -30,-40,-40,-50,-50,-40,-40,-30,
+                 -20,-30,-30,-40,-40,-30,-30,-20,
+                 -10,-20,-20,-20,-20,-20,-20,-10,
+                 20, 20,  0,  0,  0,  0, 20, 20,
+                 20, 30, 10,  0,  0, 10, 30, 20],
+}
+
+def evaluate(board):
+    '''Material and piece placement, in centipawns for the side to move'''
+    score = 0
+    for piece_type, table in PIECE_SQUARES.items():
+        value = PIECE_VALUES[piece_type]
+        for square in board.pieces(piece_type, chess.WHITE):
+            score += value + table[square ^ 56]
+        for square in board.pieces(piece_type, chess.BLACK):
+            score -= value + table[square]
+    return score if board.turn == chess.WHITE else -score
+
+class SearchTimeout(Exception):
+    '''Raised inside the search once the move's time budget is spent'''
+    pass
+
+class TranspositionTable():
+    '''Search results keyed by python-chess's Zobrist hash, in a fixed number of slots so memory stays bounded
+    A slot is overwritten by any result for the same position, by a search at least as deep,
+    or by anything once its entry is left over from an earlier move's search.'''
+    def __init__(self, size=1 << 15):
+        self.size = size
+        self.slots = [None] * size # (key, depth, kind, score, move, generation)
+        self.generation = 0
+
+    def new_search(self):
+        '''Age every entry, making them the first to go'''
+        self.generation += 1
+
+    def get(self, key):
+        entry = self.slots[key % self.size]
+        return entry if entry is not None and entry[0] == key else None
+
+    def put(self, key, depth, kind, score, move):
+        i = key % self.size
+        old = self.slots[i]
+        if old is None or old[0] == key or old[5] != self.generation or depth >= old[1]:
+            self.slots[i] = (key, depth, kind, score, move, self.generation)
+
+class Engine():
+    '''Alpha-beta search with iterative deepening, quiescence and a transposition table
+    One Engine per game, so the table built while thinking about one move helps with the next.'''
+    def __init__(self, table_size=1 << 15):
+        self.table = TranspositionTable(table_size)
+        self.nodes = 0
+        self.deadline = 0
+        self.best = None
+
+    def search(self, board, budget, max_depth=32):
+        '''Best move found within budget seconds, or None if there are no legal moves'''
+        start = time.monotonic()
+        self.deadline = start + budget
+        self.nodes = 0
+        self.table.new_search()
+        moves = list(board.legal_moves)
+        best = moves[0] if moves else None
+        for depth in range(1, max_depth + 1):
+            self.best = None
+            try:
+                score = self.negamax(board, depth, -INF, INF, 0)
+            except SearchTimeout:
+                # The unfinished iteration is thrown away
+                break
+            best = self.best or best
+            if len(moves) <= 1 or abs(score) >= MATE - max_depth:
+                break
+            # The next iteration takes several times as long, don't start one that cannot finish
+            if time.monotonic() - start > budget / 3:
+                break
+        return best
+
+    def tick(self):
+        self.nodes += 1
+        if self.nodes & 1023 == 0 and time.monotonic() > self.deadline:
+            raise SearchTimeout()
+
+    def ordered(self, board, moves, first):
+        '''Table move first, then captures and promotions by most valuable victim, least valuable attacker'''
+        def key(move):
+            if move == first:
+                return -MATE
+            victim = board.piece_type_at(move.to_square)
+            if victim is None and board.is_en_passant(move):
+                victim = chess.PAWN
+            if victim is None and not move.promotion:
+                return 0
+            gain = 10 * PIECE_VALUES.get(victim, 0) - PIECE_VALUES[board.piece_type_at(move.from_square)]
+            return -(gain + PIECE_VALUES.get(move.promotion, 0) + 1)
+        return sorted(moves, key=key)
+
+    def negamax(self, board, depth, alpha, beta, ply):
+        self.tick()
+        if ply and (board.halfmove_clock >= 100 or board.is_repetition(2)):
+            return 0
+        if depth <= 0:
+            return self.quiesce(board, alpha, beta)
+
+        key = chess.polyglot.zobrist_hash(board)
+        entry = self.table.get(key)
+        first = None
+        if entry is not None:
+            first = entry[4]
+            if ply and entry[1] >= depth:
+                # Mate scores are stored relative to the position, not the root
+                score = entry[3] - ply if entry[3] > MATE // 2 else entry[3] + ply if entry[3] < -MATE // 2 else entry[3]
+                if entry[2] == EXACT or (entry[2] == LOWER and score >= beta) or (entry[2] == UPPER and score <= alpha):
+                    return score
+
+        moves = self.ordered(board, board.legal_moves, first)
+        if not moves:
+            return -MATE + ply if board.is_check() else 0
+
+        original_alpha, best, best_move = alpha, -INF, None
+        for move in moves:
+            board.push(move)
+            try:
+                score = -self.negamax(board, depth - 1, -beta, -alpha, ply + 1)
+            finally:
+                board.pop()
+            if score > best:
+                best, best_move = score, move
+            if score > alpha:
+                alpha = score
+                if ply == 0:
+                    self.best = move
+            if alpha >= beta:
+                break
+
+        kind = UPPER if best <= original_alpha else LOWER if best >= beta else EXACT
+        stored = best + ply if best > MATE // 2 else best - ply if best < -MATE // 2 else best
+        self.table.put(key, depth, kind, stored, best_move)
+        return best
+
+    def quiesce(self, board, alpha, beta):
+        '''Play out captures until the position is quiet, so the evaluation is not fooled by a hanging piece'''
+        self.tick()
+        stand = evaluate(board)
+        if stand >= beta:
+            return stand
+        alpha = max(alpha, stand)
+        for move in self.ordered(board, board.generate_legal_captures(), None):
+            board.push(move)
+            try:
+                score = -self.quiesce(board, -beta, -alpha)
+            finally:
+                board.pop()
+            if score >= beta:
+                return score
+            alpha = max(alpha, score)
+        return alpha
+
+_engines = OrderedDict() # Inside a worker process: game -> Engine, most recently used last
+
+def think(game, fen, moves, budget, table_size, max_games):
+    '''Pick the engine's move as UCI. Runs inside a pool worker, which keeps each game's Engine between calls'''
+    engine = _engines.pop(game, None) or Engine(table_size)
+    _engines[game] = engine
+    while len(_engines) > max_games:
+        # Games that went quiet give up their tables first
+        _engines.popitem(last=False)
+    board = chess.Board(fen)
+    for uci in moves:
+        board.push_uci(uci)
+    move = engine.search(board, budget)
+    return move.uci() if move else None
+
+def forget(game):
+    _engines.pop(game, None)
+
+class EnginePool():
+    '''Runs engine searches on worker processes, so thinking never holds up the event loop or other chats
+    Each game always goes to the same worker, which keeps the game's transposition table between moves.'''
+    def __init__(self, size=2, budget=2.0, min_budget=0.2, table_size=1 << 15, games_per_worker=8):
+        self.workers = [ProcessPoolExecutor(1) for i in range(size)]
+        self.pending = [0] * size # Searches queued or running per worker
+        self.budget = budget # Seconds per move when the worker is free...
+        self.min_budget = min_budget # ... shrinking towards this as searches queue up behind each other
+        self.table_size = table_size
+        self.games_per_worker = games_per_worker # Tables a worker keeps, least recently used ones are dropped
+
+    def worker(self, game):
+        return hash(game) % len(self.workers)
+
+    async def best_move(self, game, board, limit=None):
+        '''The engine's move for game in the position on board, thinking for at most limit seconds if given'''
+        i = self.worker(game)
+        self.pending[i] += 1
+        try:
+            # A busy worker thinks less per move, so every bot game keeps getting timely replies
+            budget = max(self.budget / self.pending[i], self.min_budget)
+            if limit is not None:
+                budget = max(min(budget, limit), 0.05)
+            future = self.workers[i].submit(think, game, board.root().fen(), [move.uci() for move in board.move_stack],
+                                            budget, self.table_size, self.games_per_worker)
+            uci = await asyncio.wrap_future(future)
+        except BrokenProcessPool:
+            # The worker process died, start a fresh one for the next search
+            self.workers[i] = ProcessPoolExecutor(1)
+            raise
+        finally:
+            self.pending[i] -= 1
+        return chess.Move.from_uci(uci) if uci else None
+
+    def forget(self, game):
+        '''Free the game's table once it is over'''
+        self.workers[self.worker(game)].submit(forget, game)
+
+    def shutdown(self):
+        for worker in self.workers:
+            worker.shutdown()
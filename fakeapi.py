@@ -0,0 +1,160 @@
+import asyncio, email, email.policy, itertools, json, threading, time, urllib.parse
+from collections import deque
+
+class FakeBotAPI():
+    '''Stand-in for the Telegram Bot API on localhost, for load tests and offline runs
+    Answers getMe, getUpdates (long polling over the updates handed to push()), setWebhook, deleteWebhook,
+    sendMessage, sendPhoto, sendDocument and answerInlineQuery. Every send is reported to on_send(method, fields, when) on the
+    server's thread, with uploaded files as bytes. The server runs its own event loop on its own thread,
+    so it does not compete with the bot's loop.'''
+    def __init__(self, host="127.0.0.1", port=0, on_send=None, delay=0, username="tgchessbot"):
+        self.host = host
+        self.port = port # 0 picks a free port, see url
+        self.on_send = on_send
+        self.delay = delay # Seconds each send takes to answer, standing in for the network
+        self.username = username
+        self.updates = deque() # Updates not yet confirmed by a getUpdates offset, oldest first
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.file_ids = itertools.count(1)
+        self.requests = 0
+        self.loop = None
+        self.arrived = None # Set whenever an update is pushed, wakes long polls
+        self.server = None
+        self.thread = None
+        self.writers = set() # Open connections
+
+    @property
+    def url(self):
+        return "http://{}:{}".format(self.host, self.port)
+
+    def start(self):
+        '''Start serving on a thread of its own. Returns once the port is open'''
+        started = threading.Event()
+        def run():
+            self.loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self.loop)
+            self.arrived = asyncio.Event()
+            self.server = self.loop.run_until_complete(asyncio.start_server(self.handle, self.host, self.port))
+            self.port = self.server.sockets[0].getsockname()[1]
+            started.set()
+            self.loop.run_forever()
+            # Hang up on every client, waking long polls so their connections wind down too
+            self.arrived.set()
+            for writer in self.writers:
+                writer.close()
+            self.loop.run_until_complete(asyncio.gather(*asyncio.all_tasks(self.loop), return_exceptions = True))
+            self.server.close()
+            self.loop.run_until_complete(self.server.wait_closed())
+            self.loop.close()
+        self.thread = threading.Thread(target = run, daemon = True)
+        self.thread.start()
+        started.wait()
+        return self
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    def push(self, update):
+        '''Queue an update for the bot's next getUpdates. Safe to call from any thread; update_id is filled in'''
+        self.loop.call_soon_threadsafe(self.add, update)
+
+    def add(self, update):
+        update["update_id"] = next(self.update_ids)
+        self.updates.append(update)
+        self.arrived.set()
+
+    def backlog(self):
+        '''Updates pushed but not yet confirmed as received by the bot'''
+        return len(self.updates)
+
+    async def handle(self, reader, writer):
+        '''Serve HTTP/1.1 requests on one connection until the client closes it'''
+        self.writers.add(writer)
+        try:
+            while 1:
+                request = await reader.readline()
+                if not request:
+                    break
+                verb, path, version = request.decode("latin-1").split(" ", 2)
+                headers = {}
+                while 1:
+                    line = (await reader.readline()).decode("latin-1")
+                    if line in ("\r\n", "\n", ""):
+                        break
+                    name, _, value = line.partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                status, result = await self.dispatch(path, headers.get("content-type", ""), body)
+                data = json.dumps(result).encode("utf-8")
+                writer.write("HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n\r\n".format(
+                             status, "OK" if status == 200 else "Error", len(data)).encode("latin-1") + data)
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.writers.discard(writer)
+            writer.close()
+
+    async def dispatch(self, path, content_type, body):
+        '''(HTTP status, Bot API response) for a request to /bot<token>/<method>'''
+        self.requests += 1
+        method = path.split("?")[0].rsplit("/", 1)[-1]
+        fields = parse_fields(content_type, body)
+        if method == "getMe":
+            return 200, ok({"id": 1, "is_bot": True, "first_name": self.username, "username": self.username})
+        if method in ("setWebhook", "deleteWebhook"):
+            return 200, ok(True)
+        if method == "getUpdates":
+            return 200, ok(await self.get_updates(int(fields.get("offset") or 0), int(fields.get("limit") or 100), float(fields.get("timeout") or 0)))
+        if method not in ("sendMessage", "sendPhoto", "sendDocument", "answerInlineQuery"):
+            return 404, {"ok": False, "error_code": 404, "description": "Not Found: method not found"}
+        if self.on_send is not None:
+            self.on_send(method, fields, time.perf_counter())
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        if method == "answerInlineQuery":
+            return 200, ok(True)
+        message = {"message_id": next(self.message_ids), "date": int(time.time()), "chat": {"id": int(fields["chat_id"])}}
+        if method == "sendMessage":
+            message["text"] = fields.get("text", "")
+        elif method == "sendPhoto":
+            # An upload gets a new file_id, a file_id is sent back as it came
+            photo = fields.get("photo")
+            file_id = photo if isinstance(photo, str) else "photo{}".format(next(self.file_ids))
+            message["photo"] = [{"file_id": file_id, "file_unique_id": file_id, "width": 320, "height": 320}]
+            if fields.get("caption"):
+                message["caption"] = fields["caption"]
+        else:
+            file_id = "document{}".format(next(self.file_ids))
+            message["document"] = {"file_id": file_id, "file_unique_id": file_id}
+        return 200, ok(message)
+
+    async def get_updates(self, offset, limit, timeout):
+        '''Forget updates below offset, then return what is left, waiting up to timeout seconds for something to arrive'''
+        while self.updates and self.updates[0]["update_id"] < offset:
+            self.updates.popleft()
+        if not self.updates and timeout > 0:
+            self.arrived.clear()
+            try:
+                await asyncio.wait_for(self.arrived.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return list(itertools.islice(self.updates, limit))
+
+def ok(result):
+    return {"ok": True, "result": result}
+
+def parse_fields(content_type, body):
+    '''Form fields of a request body, multipart or urlencoded. Uploaded files come out as bytes, the rest as str'''
+    if content_type.startswith("multipart/form-data"):
+        message = email.message_from_bytes(b"Content-Type: " + content_type.encode("latin-1") + b"\r\n\r\n" + body, policy = email.policy.HTTP)
+        fields = {}
+        for part in message.iter_parts():
+            data = part.get_payload(decode = True)
+            fields[part.get_param("name", header = "content-disposition")] = data if part.get_filename() else data.decode("utf-8")
+        return fields
+    return dict(urllib.parse.parse_qsl(body.decode("utf-8")))
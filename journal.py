@@ -0,0 +1,120 @@
+import json, os
+
+class Journal():
+    '''Write-ahead journal of state changes, compacted into snapshots from time to time
+    Events are JSON objects appended one per line. Each carries a sequence number, and a snapshot
+    remembers the last one it covers, so replay stays correct if we crash halfway through compaction.
+    While a snapshot is being written, new events go to a fresh journal and the previous one is kept beside it.
+    The file is only touched by flush(), write() and switch(), which a bot runs on one disk thread in order.'''
+    def __init__(self, directory='.'):
+        self.snapshot_path = os.path.join(directory, 'snapshot.json')
+        self.journal_path = os.path.join(directory, 'journal.ndjson')
+        self.previous_path = os.path.join(directory, 'journal.previous.ndjson') # Events until a snapshot in progress
+        self.seq = 0 # Sequence number of the last event appended
+        self.pending = [] # Encoded events not yet written out
+        self.since_snapshot = 0
+        self.file = None
+
+    def load(self):
+        '''Return (snapshot state or None, list of events recorded after it)
+        Must be called once before appending. A torn last line from a crash is discarded.'''
+        snapshot, covered = None, 0
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path) as f:
+                data = json.load(f)
+            snapshot, covered = data["state"], data["seq"]
+        self.seq = covered
+
+        events = []
+        for path in (self.previous_path, self.journal_path):
+            if not os.path.exists(path):
+                continue
+            good = 0 # Offset just past the last intact line
+            with open(path, "rb") as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        break
+                    good += len(line)
+                    if event["seq"] > covered:
+                        events.append(event)
+                        self.seq = event["seq"]
+            # Cut off a torn write so new events do not get glued onto it
+            if good != os.path.getsize(path):
+                os.truncate(path, good)
+        self.since_snapshot = len(events)
+        self.file = open(self.journal_path, "a")
+        return snapshot, events
+
+    def append(self, event):
+        '''Queue an event, it reaches the disk on the next flush'''
+        self.seq += 1
+        event["seq"] = self.seq
+        self.pending.append(json.dumps(event, separators=(',', ':')))
+        self.since_snapshot += 1
+
+    def take(self):
+        '''Hand over the queued events, for write() on another thread'''
+        lines, self.pending = self.pending, []
+        return lines
+
+    def write(self, lines):
+        '''Write and fsync lines from take() as one batch'''
+        if not lines:
+            return
+        self.file.write("\n".join(lines) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def flush(self):
+        self.write(self.take())
+
+    def begin_rotation(self):
+        '''Return the seq that a snapshot of the current state covers, and the events still to be written
+        before switch() starts a new journal'''
+        self.since_snapshot = 0
+        return self.seq, self.take()
+
+    def switch(self, lines):
+        '''Write lines, then start an empty journal. Events so far stay in the previous journal
+        until write_snapshot() makes them redundant.'''
+        self.write(lines)
+        self.file.close()
+        if os.path.exists(self.previous_path):
+            # The last snapshot never made it, keep its events too
+            with open(self.previous_path, "ab") as previous, open(self.journal_path, "rb") as f:
+                previous.write(f.read())
+                previous.flush()
+                os.fsync(previous.fileno())
+            os.remove(self.journal_path)
+        else:
+            os.replace(self.journal_path, self.previous_path)
+        self.file = open(self.journal_path, "w")
+
+    def rotate(self):
+        '''Start an empty journal right away and return the seq that a snapshot of the current state covers'''
+        seq, lines = self.begin_rotation()
+        self.switch(lines)
+        return seq
+
+    def write_snapshot(self, seq, state):
+        '''Atomically replace the snapshot with state as of seq, then drop the previous journal
+        Touches no attributes the event loop uses, so it can run on a worker thread while events keep coming'''
+        tmp = self.snapshot_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"seq": seq, "state": state}, f, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.snapshot_path)
+        os.remove(self.previous_path)
+
+    def snapshot(self, state):
+        '''Atomically replace the snapshot with state, then start an empty journal'''
+        self.write_snapshot(self.rotate(), state)
+
+    def close(self):
+        self.flush()
+        self.file.close()
@@ -0,0 +1,357 @@
+'''Load benchmark for @tgchessbot against a stand-in Telegram Bot API server
+
+Runs the real bot over HTTP against fakeapi.FakeBotAPI on localhost and drives it with either many concurrent
+games played from PGN move lists, or updates replayed from a msglog directory. Prints a JSON report of
+throughput, response latency, render time and memory, and exits with status 1 if a run regressed against an
+earlier report:
+
+    python3 loadbench.py --games 50 > base.json
+    python3 loadbench.py --games 50 --baseline base.json
+    python3 loadbench.py --replay msglog --speed 10
+    python3 loadbench.py --games 50 --webhook
+    python3 loadbench.py --games 50 --shards 4
+
+With --webhook, updates are POSTed to the bot's webhook server instead of being long-polled from the fake server.
+With --shards, the bot runs as a shards.ShardFront and that many worker processes. The workers' internals are out
+of reach then, so a chat counts as answered once the bot has sent nothing to it for a moment, and render figures
+are left out of the report.
+
+Latency is measured from an update being handed to the fake server, or to the webhook, until the bot's first send to
+that chat.
+In game mode each game waits for the bot to finish answering before its next move, so many games run side by
+side but each one is played like a person would. Replays are open loop, at the recorded pace times --speed.
+'''
+import argparse, asyncio, itertools, json, logging, os, resource, secrets, shutil, sys, tempfile, time
+import chess, chess.pgn
+from tgchessbot import *
+from fakeapi import FakeBotAPI
+from shards import ShardFront
+import benchmark
+
+TOKEN = "0:loadbench"
+QUIET = 0.2 # Seconds without sends to a chat after which a sharded bot is taken to be done with it
+
+def pgn_games(path):
+    '''SAN move lists of every game in a PGN file'''
+    games = []
+    with open(path) as f:
+        while 1:
+            game = chess.pgn.read_game(f)
+            if game is None:
+                break
+            board = game.board()
+            moves = []
+            for move in game.mainline_moves():
+                moves.append(board.san(move))
+                board.push(move)
+            if moves:
+                games.append(moves)
+    return games
+
+def as_update(msg):
+    '''Rebuild the update around a message from the msglog, which keeps only the message itself'''
+    if "chat" in msg:
+        return {"message": msg}
+    if "data" in msg:
+        return {"callback_query": msg}
+    if "result_id" in msg:
+        return {"chosen_inline_result": msg}
+    if "query" in msg:
+        return {"inline_query": msg}
+    return None
+
+def expects_answer(update):
+    '''Whether the bot answers an update: commands, move-shaped text and inline queries. Chatter is ignored'''
+    if "inline_query" in update:
+        return True
+    text = (update.get("message") or {}).get("text", "").split()
+    return bool(text) and (text[0].startswith("/") or bool(MOVE_PATTERN.match(text[0])))
+
+def percentiles(samples):
+    if not samples:
+        return {"count": 0}
+    samples = sorted(samples)
+    pick = lambda q: samples[min(int(q * len(samples)), len(samples) - 1)]
+    return {"count": len(samples), "mean": sum(samples) / len(samples), "p50": pick(0.5), "p90": pick(0.9), "p99": pick(0.99), "max": samples[-1]}
+
+def rss_mb():
+    '''Current resident memory of this process, or None where /proc is missing'''
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError):
+        return None
+
+class LoadBench():
+    '''One run: the bot, the fake server, and the bookkeeping matching updates with the sends they caused'''
+    def __init__(self, options):
+        self.options = options
+        self.pending = {} # Chat id, or inline query id -> push times of updates still waiting for an answer
+        self.waiters = {} # Chat id -> future of a game waiting for the bot's answer
+        self.latencies = []
+        self.pushed, self.sends, self.timeouts = 0, 0, 0
+        self.first_push, self.last_send = None, None
+        self.loop = None
+        self.server = None
+        self.bot = None # The bot, or with --shards the ShardFront
+        self.last_sent = {} # Chat id -> when it was last sent something, with --shards
+        self.webhook = None # With --webhook, the bot's WebhookServer...
+        self.outgoing = asyncio.Queue() # ... and the updates still to be POSTed to it
+        self.unposted = 0
+        self.update_ids = itertools.count(1)
+
+    def on_send(self, method, fields, when):
+        '''Runs on the server's thread'''
+        key = fields.get("inline_query_id") if method == "answerInlineQuery" else int(fields["chat_id"])
+        self.loop.call_soon_threadsafe(self.answered, key, when)
+
+    def answered(self, key, when):
+        self.sends += 1
+        self.last_send = when
+        self.last_sent[key] = when
+        for pushed in self.pending.pop(key, ()):
+            self.latencies.append(when - pushed)
+        waiter = self.waiters.pop(key, None)
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    def push(self, update):
+        now = time.perf_counter()
+        self.first_push = self.first_push or now
+        self.pushed += 1
+        if expects_answer(update):
+            key = update["inline_query"]["id"] if "inline_query" in update else update["message"]["chat"]["id"]
+            self.pending.setdefault(key, []).append(now)
+        if self.webhook is None:
+            self.server.push(update)
+        else:
+            update["update_id"] = next(self.update_ids)
+            self.unposted += 1
+            self.outgoing.put_nowait(update)
+
+    async def post_updates(self):
+        '''POST pushed updates to the webhook in order over one kept-alive connection, resending refused ones, as Telegram does'''
+        while self.webhook.server is None:
+            await asyncio.sleep(0.01)
+        reader, writer = await asyncio.open_connection(self.webhook.host, self.webhook.port)
+        while 1:
+            update = await self.outgoing.get()
+            body = json.dumps(update).encode("utf-8")
+            while 1:
+                writer.write("POST {} HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\nX-Telegram-Bot-Api-Secret-Token: {}\r\n"
+                             "Content-Length: {}\r\n\r\n".format(self.webhook.path, self.webhook.secret.decode("utf-8"), len(body)).encode("latin-1") + body)
+                await writer.drain()
+                status = int((await reader.readline()).split()[1])
+                while (await reader.readline()) not in (b"\r\n", b""):
+                    pass
+                if status != 503:
+                    break
+                await asyncio.sleep(0.05)
+            if status != 200:
+                log.warning("Webhook answered %d", status)
+            self.unposted -= 1
+
+    def idle(self, chat_id=None):
+        bot = self.bot
+        if self.options.shards:
+            since = time.perf_counter() - (self.last_sent.get(chat_id, 0) if chat_id is not None else self.last_send or 0)
+            if chat_id is not None:
+                return since >= QUIET
+            if self.webhook is not None and (self.unposted or self.webhook.queue.qsize()):
+                return False
+            return not self.server.backlog() and not bot.pending() and since >= QUIET
+        if chat_id is not None:
+            return chat_id not in bot.chats.queues and chat_id not in bot.outbox.busy
+        if self.webhook is not None and (self.unposted or self.webhook.queue.qsize()):
+            return False
+        return not self.server.backlog() and not bot.chats.queues and not bot.outbox.busy
+
+    async def settle(self, chat_id=None, quiet=0.0):
+        '''Wait until the bot is done with chat_id, or with everything, and has stayed that way for quiet seconds'''
+        since = None
+        while 1:
+            if self.idle(chat_id):
+                since = since or time.perf_counter()
+                if time.perf_counter() - since >= quiet:
+                    return
+            else:
+                since = None
+            await asyncio.sleep(0.005)
+
+    async def say(self, chat_id, user_id, text):
+        '''Send text as user_id in chat_id and wait until the bot has answered it in full'''
+        waiter = self.waiters[chat_id] = self.loop.create_future()
+        self.push({"message": {"message_id": self.pushed + 1, "date": int(time.time()), "text": text,
+                               "chat": {"id": chat_id, "type": "group", "title": "loadbench"},
+                               "from": {"id": user_id, "is_bot": False, "first_name": "p", "username": "p{}".format(user_id)}}})
+        try:
+            await asyncio.wait_for(waiter, self.options.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+        # A board sent after its announcement must not count as the answer to the next move
+        await self.settle(chat_id)
+
+    async def play(self, n, moves):
+        '''Game n, in a group of its own between two players, played round after round from a SAN move list'''
+        chat_id, white, black = -1000000 - n, 1000000 + 2 * n, 1000001 + 2 * n
+        for _ in range(self.options.rounds):
+            await self.say(chat_id, white, "/create white")
+            await self.say(chat_id, black, "/join")
+            board = chess.Board()
+            for san in moves:
+                await asyncio.sleep(self.options.think)
+                await self.say(chat_id, white if board.turn == chess.WHITE else black, san)
+                board.push_san(san)
+            if not board.is_game_over():
+                await self.say(chat_id, white if board.turn == chess.WHITE else black, "/resign")
+
+    async def games(self):
+        games = pgn_games(self.options.pgn) if self.options.pgn else [benchmark.GAME]
+        await asyncio.gather(*(self.play(n, games[n % len(games)]) for n in range(self.options.games)))
+
+    async def replay(self):
+        '''Push the msglog's updates at their recorded pace, sped up by --speed, or all at once with --speed 0'''
+        start, first = time.perf_counter(), None
+        for msg in MessageLog(self.options.replay).read():
+            update = as_update(msg)
+            if update is None:
+                continue
+            date = msg.get("date", first or 0)
+            first = date if first is None else first
+            if self.options.speed > 0:
+                delay = start + (date - first) / self.options.speed - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            self.push(update)
+        await self.settle(quiet = 0.5)
+
+    async def run(self):
+        options = self.options
+        self.loop = asyncio.get_running_loop()
+        self.server = FakeBotAPI(on_send = self.on_send, delay = options.api_delay).start()
+        data_dir = tempfile.mkdtemp(prefix = "loadbench")
+        get_assets()
+        # The point is how fast the bot can go, not Telegram's rate limits
+        unpaced = dict(global_rate = 1e9, private_rate = 1e9, group_rate = 1e9, burst = 1e9)
+        if options.shards:
+            self.bot = bot = ShardFront(TOKEN, options.shards, directory = data_dir, api_url = self.server.url,
+                                        options = dict(render_workers = options.render_workers, render_mode = options.render_mode,
+                                                       api_workers = options.api_workers, engine_workers = 1),
+                                        outbox = None if options.paced else unpaced)
+            bot.start()
+            await bot.wait_ready()
+        else:
+            self.bot = bot = tgchessBot(TOKEN, api = BotAPI(TOKEN, self.server.url, pool_size = options.api_workers), data_dir = data_dir,
+                                        render_workers = options.render_workers, render_mode = options.render_mode,
+                                        api_workers = options.api_workers, engine_workers = 1)
+            if not options.paced:
+                bot.outbox = Outbox(bot, **unpaced)
+            bot.load_state()
+        tasks = []
+        if options.webhook:
+            self.webhook = WebhookServer(bot, secrets.token_urlsafe(16), port = 0)
+            tasks.append(asyncio.ensure_future(self.post_updates()))
+        if options.shards:
+            tasks.append(asyncio.ensure_future(bot.run_forever(poll_timeout = 1, webhook = self.webhook)))
+        else:
+            tasks.append(asyncio.ensure_future(bot.run_forever(save_interval = 1, poll_timeout = 1, webhook = self.webhook)))
+        rss_start, cpu_start = rss_mb(), time.process_time()
+        try:
+            await (self.replay() if options.replay else self.games())
+            await self.settle()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.sleep(0.1) # Let run_forever stop the webhook server and its connections wind down
+            await self.loop.run_in_executor(None, bot.close)
+            self.server.stop()
+            shutil.rmtree(data_dir, ignore_errors = True)
+        return self.report(rss_start, time.process_time() - cpu_start)
+
+    def report(self, rss_start, cpu):
+        options = self.options
+        duration = (self.last_send or time.perf_counter()) - (self.first_push or time.perf_counter())
+        histograms = {(h["name"], tuple(sorted(h["labels"].items()))): h for h in METRICS.snapshot()["histograms"]}
+        def timing(name, **labels):
+            h = histograms.get((name, tuple(sorted(labels.items()))))
+            return {"count": h["count"], "mean": h["sum"] / h["count"], "p50": h["p50"], "p99": h["p99"], "max": h["max"]} if h else {"count": 0}
+        return {"mode": "replay" if options.replay else "games",
+                "ingest": "webhook" if options.webhook else "polling",
+                "shards": options.shards,
+                "options": vars(options),
+                "updates": self.pushed,
+                "sends": self.sends,
+                "timeouts": self.timeouts,
+                "unanswered": sum(len(times) for times in self.pending.values()),
+                "duration_seconds": duration,
+                "cpu_seconds": cpu,
+                "updates_per_second": self.pushed / duration if duration > 0 else None,
+                "sends_per_second": self.sends / duration if duration > 0 else None,
+                "latency_seconds": percentiles(self.latencies),
+                # Bucketed, so p50 and p99 are bucket bounds, see metrics.py
+                "render_seconds": None if options.shards else
+                                  {"draw_incremental": timing("draw_fen_seconds", renderer = "incremental"),
+                                   "draw_full": timing("draw_fen_seconds", renderer = "full"),
+                                   "jpeg_encode": timing("jpeg_encode_seconds")},
+                "render_cache_hit_ratio": None if options.shards else
+                                          self.bot.board_images.hits / max(self.bot.board_images.hits + self.bot.board_images.misses, 1),
+                "memory_mb": {"rss_start": rss_start, "rss_end": rss_mb(),
+                              # ru_maxrss is in kilobytes on Linux
+                              "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                              # Largest of the worker processes, with --shards
+                              "peak_rss_children": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024},
+                "metrics": METRICS.snapshot()}
+
+def regressions(report, baseline, tolerance):
+    '''What got worse than baseline by more than tolerance, as readable lines'''
+    checks = [("updates_per_second", report.get("updates_per_second"), baseline.get("updates_per_second"), False),
+              ("latency p50", report["latency_seconds"].get("p50"), baseline["latency_seconds"].get("p50"), True),
+              ("latency p99", report["latency_seconds"].get("p99"), baseline["latency_seconds"].get("p99"), True),
+              ("peak rss", report["memory_mb"]["peak_rss"], baseline["memory_mb"]["peak_rss"], True)]
+    problems = []
+    for name, now, before, lower_is_better in checks:
+        if now is None or not before:
+            continue
+        if (now > before * (1 + tolerance)) if lower_is_better else (now < before * (1 - tolerance)):
+            problems.append("{}: {:.4g} against {:.4g} before".format(name, now, before))
+    if report["timeouts"] > baseline["timeouts"]:
+        problems.append("timeouts: {} against {} before".format(report["timeouts"], baseline["timeouts"]))
+    return problems
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description = "Load benchmark for @tgchessbot against a local stand-in Bot API server")
+    parser.add_argument("--games", type = int, default = 20, help = "Games played at the same time")
+    parser.add_argument("--rounds", type = int, default = 1, help = "Games each of them plays one after another")
+    parser.add_argument("--pgn", help = "PGN file whose games are played, by default Kasparov vs Topalov 1999")
+    parser.add_argument("--think", type = float, default = 0, help = "Seconds a player waits before each move")
+    parser.add_argument("--replay", metavar = "MSGLOG", help = "Replay the updates in this msglog directory instead of playing games")
+    parser.add_argument("--speed", type = float, default = 0, help = "Replay this many times faster than recorded, 0 for all at once")
+    parser.add_argument("--timeout", type = float, default = 30, help = "Seconds to wait for an answer before counting a timeout")
+    parser.add_argument("--api-delay", type = float, default = 0, help = "Seconds the fake server takes to answer each send")
+    parser.add_argument("--api-workers", type = int, default = 10)
+    parser.add_argument("--render-workers", type = int, default = 2)
+    parser.add_argument("--render-mode", default = "thread", choices = ("thread", "process"))
+    parser.add_argument("--webhook", action = "store_true", help = "POST updates to the bot's webhook server instead of having it poll")
+    parser.add_argument("--shards", type = int, default = 0, help = "Run the bot as this many worker processes behind a shard front")
+    parser.add_argument("--paced", action = "store_true", help = "Keep Telegram's rate limits in the outbox")
+    parser.add_argument("--baseline", help = "Earlier report to compare against")
+    parser.add_argument("--tolerance", type = float, default = 0.2, help = "Allowed fraction of slowdown against the baseline")
+    parser.add_argument("--out", help = "Write the report here instead of stdout")
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    logging.basicConfig(level = logging.WARNING, format = "%(asctime)s %(levelname)s %(name)s: %(message)s")
+    options = parse_args()
+    report = asyncio.run(LoadBench(options).run())
+    text = json.dumps(report, indent = 2, default = str)
+    if options.out:
+        with open(options.out, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    if options.baseline:
+        with open(options.baseline) as f:
+            problems = regressions(report, json.load(f), options.tolerance)
+        for problem in problems:
+            print("Regression: " + problem, file = sys.stderr)
+        sys.exit(1 if problems else 0)
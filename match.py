@@ -1,8 +1,26 @@
+import time, base64
+from array import array
 import chess # https://github.com/niklasf/python-chess
 from renderer import *
+from metrics import METRICS
+
+STARTING_BOARD = chess.Board() # Compared against instead of FEN strings, which are slow to build
+
+def pack_moves(moves):
+    '''Pack moves into 2 bytes each: from square, to square and promotion piece type'''
+    packed = array('H', (move.from_square | move.to_square << 6 | (move.promotion or 0) << 12 for move in moves))
+    return base64.b64encode(packed.tobytes()).decode('ascii')
+
+def unpack_moves(data):
+    '''Inverse of pack_moves'''
+    packed = array('H')
+    packed.frombytes(base64.b64decode(data))
+    return [chess.Move(m & 63, m >> 6 & 63, (m >> 12) or None) for m in packed]
 
 class Match():
     '''Class to handle match related stuff and interface with python-chess'''
+    __slots__ = ('board', 'chat_id', 'white_id', 'black_id', 'white_name', 'black_name', 'drawoffer', 'frames', 'last_active', 'moves_table', 'started', 'clock', 'turn_started')
+
     def __init__(self, chat_id):
         ''' Set up local variables'''
         self.board = chess.Board()
@@ -11,9 +29,53 @@ class Match():
         self.black_id = None
         self.white_name = None
         self.black_name = None
-        self.draw_offer = None
-        self.imgurid = None
         self.drawoffer = None
+        self.frames = IncrementalRenderer()
+        self.last_active = time.time() # For evicting idle matches to disk
+        self.moves_table = None # Spelling -> parse_move's answer in the current position, for spellings seen so far
+        self.started = time.time()
+        self.clock = None # [White's seconds, Black's seconds, increment] as of turn_started, None if untimed
+        self.turn_started = None # When the side to move got the move, once both players are in
+
+    def __getstate__(self):
+        '''Pickle as the compact form, rendered frames are only a cache'''
+        return self.to_dict()
+
+    def __setstate__(self, state):
+        '''Restored matches start with a full redraw'''
+        if "moves" not in state:
+            # Attribute dict pickled by older versions
+            state = {"chat_id": state["chat_id"], "fen": state["board"].root().fen(), "moves": pack_moves(state["board"].move_stack),
+                     "white": [state["white_id"], state["white_name"]], "black": [state["black_id"], state["black_name"]],
+                     "drawoffer": state["drawoffer"]}
+        self.__init__(state["chat_id"])
+        self.load(state)
+
+    def to_dict(self):
+        '''Compact representation of the match: starting FEN, packed moves, players and draw offer'''
+        root = self.board.root()
+        return {"chat_id": self.chat_id, "fen": None if root == STARTING_BOARD else root.fen(), "moves": pack_moves(self.board.move_stack),
+                "white": [self.white_id, self.white_name], "black": [self.black_id, self.black_name], "drawoffer": self.drawoffer,
+                "started": self.started, "clock": self.clock and list(self.clock), "turn_started": self.turn_started}
+
+    @classmethod
+    def from_dict(cls, d):
+        '''Rebuild a match from to_dict output'''
+        match = cls(d["chat_id"])
+        match.load(d)
+        return match
+
+    def load(self, d):
+        self.board = chess.Board(d["fen"] or chess.STARTING_FEN)
+        for move in unpack_moves(d["moves"]):
+            self.board.push(move)
+        self.white_id, self.white_name = d["white"]
+        self.black_id, self.black_name = d["black"]
+        self.drawoffer = d["drawoffer"]
+        self.moves_table = None
+        self.started = d.get("started") or self.started
+        self.clock = d.get("clock")
+        self.turn_started = d.get("turn_started")
 
     def joinw(self, pid, pname):
         '''Player joins as White'''
@@ -77,29 +139,81 @@ class Match():
         else:
             return None
 
+    def status(self):
+        '''Plain summary for /games: both players as [id, name], the move number, and [id, name, colour] of the side to move once both are in'''
+        turn = None
+        if self.white_id != None and self.black_id != None:
+            turn_id = self.get_turn_id()
+            turn = [turn_id, self.get_name(turn_id), self.get_color(turn_id)]
+        return {"white": [self.white_id, self.white_name], "black": [self.black_id, self.black_name], "move": self.board.fullmove_number, "turn": turn}
+
+    def set_clock(self, base, increment):
+        '''Time control: base seconds for each side, plus increment seconds for every move made'''
+        self.clock = [base, base, increment]
+
+    def deadline(self):
+        '''When the side to move runs out of time. None for untimed games, or until both players are in'''
+        if self.clock is None or self.turn_started is None:
+            return None
+        return self.turn_started + self.clock[0 if self.board.turn else 1]
+
+    def remaining(self, now):
+        '''Seconds left on [White's, Black's] clocks at now'''
+        left = self.clock[:2]
+        if self.turn_started is not None:
+            left[0 if self.board.turn else 1] -= max(now - self.turn_started, 0)
+        return left
+
+    def clock_text(self, now):
+        '''Both clocks for captions, empty for untimed games'''
+        if self.clock is None:
+            return ""
+        def fmt(seconds):
+            seconds = max(int(seconds), 0)
+            if seconds >= 3600:
+                return "{}:{:02d}:{:02d}".format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+            return "{}:{:02d}".format(seconds // 60, seconds % 60)
+        white, black = self.remaining(now)
+        return " White {} | Black {}".format(fmt(white), fmt(black))
+
+    @METRICS.timer("parse_move_seconds")
     def parse_move(self, m):
-        '''Feed move into python-chess to simulate'''
+        '''Feed move into python-chess to simulate. Answers are remembered until a move is made, so a spelling
+        sent again in the same position, e.g. the same illegal move from several group members, is parsed once'''
+        if self.moves_table is None:
+            self.moves_table = {}
+        elif m in self.moves_table:
+            return self.moves_table[m]
+
         # python-chess uses O instead of 0
-        m = m.replace('0', 'O')
+        spelling = m.replace('0', 'O')
 
         # Check if move is in SAN.
         # python-chess: Raises ValueError if the SAN is invalid or ambiguous.
         try:
-            move = self.board.parse_san(m)
+            move = self.board.parse_san(spelling)
         except ValueError:
             # Check if move is in UCI notation
             # python-chess Raises ValueError if the move is invalid or illegal in the current position (but not a null move).
             try:
-                move = self.board.parse_uci(m)
+                move = self.board.parse_uci(spelling)
             except ValueError:
                 # If neither forms or illegal, the move is invalid
-                return None
+                move = None
+        self.moves_table[m] = move
         return move
 
-    def make_move(self, m):
-        move = self.parse_move(m)
+    def make_move(self, move, now=None):
+        '''Play a move already checked by parse_move, made at time now'''
         if not move:
             return "Invalid"
+        now = now or time.time()
+
+        # The mover's clock is charged for the time they took, then credited the increment
+        if self.clock is not None and self.turn_started is not None:
+            side = 0 if self.board.turn else 1
+            self.clock[side] += self.clock[2] - (now - self.turn_started)
+        self.turn_started = now
         
         # Making a move invalidates any existing draw offers
         if self.drawoffer != None:
@@ -108,6 +222,7 @@ class Match():
         # At this point, "move" is bound to be valid and legal.
         # i.e. (move in self.board.legal_moves) == True
         self.board.push(move)
+        self.moves_table = None
         # The order of testing for check and checkmate is important here!
         # That is because Board.is_check() will also return true if the game position is actually checkmate.
         # See https://github.com/niklasf/python-chess/blob/0d007c23f593957f049b16df105d82d447e5833b/chess/__init__.py#L1659
@@ -123,11 +238,6 @@ class Match():
         '''Offer rejected either explicitly or when a move is made'''
         self.drawoffer = None
 
-    # Return an image
-    def print_board(self, chat_id):
-        '''Sends fen to renderer class to draw current chessboard'''
-        renderer = Renderer(self.board.turn)
-        filename = './matches/{}.jpg'.format('tgchessbot_'+str(chat_id))
-        fen = self.board.fen().split()[0]
-        img = renderer.draw_fen(fen).save(filename, "JPEG")
-        return filename
+    def board_key(self):
+        '''Key identifying the image of the current position: (board FEN, orientation)'''
+        return (self.board.board_fen(), self.board.turn)
@@ -0,0 +1,118 @@
+import json, os, time
+from match import *
+
+class MatchStore():
+    '''gamelog: chat_id -> Match, with idle matches evicted to disk and loaded back on demand
+    Evictions only happen while a snapshot is taken, and the matches evicted together go into one file named
+    after that snapshot, so the files a snapshot refers to are never overwritten and snapshot + journal replay
+    stays exact. An evicted match is found by [file, offset, length], or by file alone if older versions wrote it.'''
+    def __init__(self, directory='./matches', ttl=60*60):
+        self.directory = directory
+        self.ttl = ttl # Seconds a match may sit idle before it is evicted
+        self.resident = {} # chat_id -> Match
+        self.evicted = {} # chat_id -> where its compact form is, see read()
+        os.makedirs(directory, exist_ok=True)
+
+    def __contains__(self, chat_id):
+        return chat_id in self.resident or chat_id in self.evicted
+
+    def __len__(self):
+        return len(self.resident) + len(self.evicted)
+
+    def __getitem__(self, chat_id):
+        match = self.get(chat_id)
+        if match is None:
+            raise KeyError(chat_id)
+        return match
+
+    def __setitem__(self, chat_id, match):
+        self.evicted.pop(chat_id, None)
+        self.resident[chat_id] = match
+
+    def get(self, chat_id, default=None):
+        '''Return the chat's match, reading it back from disk if it was evicted'''
+        match = self.resident.get(chat_id)
+        if match is None:
+            if chat_id not in self.evicted:
+                return default
+            match = self.resident[chat_id] = self.read(self.evicted.pop(chat_id))
+        match.last_active = time.time()
+        return match
+
+    def peek(self, chat_id):
+        '''Like get, but an evicted match is read without being brought back into memory'''
+        match = self.resident.get(chat_id)
+        if match is None and chat_id in self.evicted:
+            match = self.read(self.evicted[chat_id])
+        return match
+
+    def read(self, entry):
+        if isinstance(entry, str):
+            with open(os.path.join(self.directory, entry)) as f:
+                return Match.from_dict(json.load(f))
+        name, offset, length = entry
+        with open(os.path.join(self.directory, name), "rb") as f:
+            f.seek(offset)
+            return Match.from_dict(json.loads(f.read(length)))
+
+    def pop(self, chat_id):
+        match = self[chat_id]
+        del self.resident[chat_id]
+        return match
+
+    def values(self):
+        '''Every match, loading evicted ones back in. Avoid on hot paths'''
+        for chat_id in list(self.evicted):
+            self.get(chat_id)
+        return list(self.resident.values())
+
+    def idle(self, now=None):
+        '''Matches idle for longer than ttl, as (chat_id, match, last_active, compact form) for write_batch and evict'''
+        now = now or time.time()
+        return [(chat_id, match, match.last_active, match.to_dict()) for chat_id, match in self.resident.items()
+                if now - match.last_active >= self.ttl]
+
+    def write_batch(self, tag, batch):
+        '''Write the compact forms in batch to one file with a single fsync. Returns the file's name and where in it
+        each match is. Only reads batch, so it can run on a worker thread
+        tag distinguishes this snapshot's file from those of earlier snapshots'''
+        name = "evicted.{}.ndjson".format(tag)
+        path = os.path.join(self.directory, name)
+        spans, offset = [], 0
+        with open(path + ".tmp", "wb") as f:
+            for chat_id, match, last_active, d in batch:
+                line = json.dumps(d, separators=(',', ':')).encode("utf-8") + b"\n"
+                f.write(line)
+                spans.append((offset, len(line)))
+                offset += len(line)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+        return name, spans
+
+    def evict(self, batch, name, spans):
+        '''Drop the matches of a written batch from memory, except those used since it was taken'''
+        for (chat_id, match, last_active, d), (offset, length) in zip(batch, spans):
+            if self.resident.get(chat_id) is match and match.last_active == last_active:
+                self.evicted[chat_id] = [name, offset, length]
+                del self.resident[chat_id]
+
+    def live_files(self):
+        '''Files backing evicted matches, as a snapshot taken now refers to them'''
+        return set(entry if isinstance(entry, str) else entry[0] for entry in self.evicted.values())
+
+    def collect_garbage(self, live):
+        '''Delete files not in live, from live_files(). Only call once the snapshot taken with live is durable'''
+        for name in os.listdir(self.directory):
+            if name.endswith((".json", ".ndjson")) and name not in live:
+                os.remove(os.path.join(self.directory, name))
+
+    def dump(self):
+        '''Resident matches in compact form, and the files of the evicted ones'''
+        return {"resident": [match.to_dict() for match in self.resident.values()],
+                "evicted": [[chat_id, name] for chat_id, name in self.evicted.items()]}
+
+    def restore(self, state):
+        '''Inverse of dump'''
+        self.resident = dict((m["chat_id"], Match.from_dict(m)) for m in state["resident"])
+        self.evicted = dict((chat_id, name) for chat_id, name in state["evicted"])
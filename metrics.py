@@ -0,0 +1,189 @@
+import asyncio, bisect, functools, threading, time
+from contextlib import contextmanager
+
+# Upper bounds, in seconds, of the latency histogram buckets
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float("inf"))
+
+class Histogram():
+    '''Counts of observations per latency bucket, their sum and the largest one'''
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+        self.lock = threading.Lock() # Renders observe from worker threads
+
+    def observe(self, seconds):
+        i = bisect.bisect_left(BUCKETS, seconds)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += seconds
+            self.count += 1
+            if seconds > self.max:
+                self.max = seconds
+
+    def quantile(self, q):
+        '''Upper bound of the bucket holding the q-th quantile'''
+        target, seen = q * self.count, 0
+        for bound, n in zip(BUCKETS, self.counts):
+            seen += n
+            if seen >= target and n:
+                return min(bound, self.max)
+        return 0.0
+
+class RateMeter():
+    '''Events per second over the last window seconds, in one-second slots'''
+    def __init__(self, window=60):
+        self.window = window
+        self.slots = [0] * window
+        self.second = int(time.time())
+
+    def advance(self, now):
+        second = int(now)
+        if second - self.second >= self.window:
+            self.slots = [0] * self.window
+        else:
+            for s in range(self.second + 1, second + 1):
+                self.slots[s % self.window] = 0
+        self.second = max(second, self.second)
+
+    def mark(self, n=1):
+        self.advance(time.time())
+        self.slots[self.second % self.window] += n
+
+    def rate(self):
+        self.advance(time.time())
+        return sum(self.slots) / self.window
+
+class Metrics():
+    '''In-process counters, latency histograms and gauges, reported by /metrics and the Prometheus endpoint
+    Names and labels follow Prometheus conventions so both reports come from the same data.'''
+    def __init__(self):
+        self.histograms = {} # (name, labels) -> Histogram
+        self.counters = {} # (name, labels) -> count
+        self.rates = {} # name -> RateMeter
+        self.gauges = {} # name -> function returning the current value
+        self.lock = threading.Lock()
+
+    def histogram(self, name, labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(key, Histogram())
+        return histogram
+
+    def observe(self, name, seconds, **labels):
+        self.histogram(name, labels).observe(seconds)
+
+    @contextmanager
+    def timed(self, name, **labels):
+        '''Observe how long the with block takes'''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.histogram(name, labels).observe(time.perf_counter() - start)
+
+    def timer(self, name, **labels):
+        '''Decorator observing how long each call takes'''
+        def wrap(function):
+            histogram = self.histogram(name, labels)
+            @functools.wraps(function)
+            def timed(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    histogram.observe(time.perf_counter() - start)
+            return timed
+        return wrap
+
+    def inc(self, name, n=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+        meter = self.rates.get(name)
+        if meter is not None:
+            meter.mark(n)
+
+    def track_rate(self, name, window=60):
+        '''Also keep the per second rate of counter name, reported as <name without _total>_per_second'''
+        self.rates[name] = RateMeter(window)
+
+    def gauge(self, name, function):
+        self.gauges[name] = function
+
+    def summary(self):
+        '''Human readable report for /metrics'''
+        lines = []
+        for name, function in sorted(self.gauges.items()):
+            lines.append("{} {}".format(name, fmt_number(function())))
+        for name, meter in sorted(self.rates.items()):
+            lines.append("{}_per_second {:.2f}".format(rate_name(name), meter.rate()))
+        for (name, labels), value in sorted(self.counters.items()):
+            lines.append("{}{} {}".format(name, fmt_labels(labels), value))
+        for (name, labels), h in sorted(self.histograms.items()):
+            if h.count:
+                lines.append("{}{} n={} avg={} p50={} p99={} max={}".format(name, fmt_labels(labels), h.count, fmt_seconds(h.sum / h.count),
+                             fmt_seconds(h.quantile(0.5)), fmt_seconds(h.quantile(0.99)), fmt_seconds(h.max)))
+        return "\n".join(lines)
+
+    def snapshot(self):
+        '''Everything as plain data, for machine-readable reports such as loadbench.py's'''
+        return {"gauges": {name: function() for name, function in sorted(self.gauges.items())},
+                "counters": [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in sorted(self.counters.items())],
+                "histograms": [{"name": name, "labels": dict(labels), "count": h.count, "sum": h.sum, "max": h.max,
+                                "p50": h.quantile(0.5), "p99": h.quantile(0.99)}
+                               for (name, labels), h in sorted(self.histograms.items()) if h.count]}
+
+    def prometheus(self, prefix="tgchessbot_"):
+        '''Prometheus text exposition format'''
+        lines = []
+        for name, function in sorted(self.gauges.items()):
+            lines.append("# TYPE {}{} gauge".format(prefix, name))
+            lines.append("{}{} {}".format(prefix, name, function()))
+        for name, meter in sorted(self.rates.items()):
+            lines.append("# TYPE {}{}_per_second gauge".format(prefix, rate_name(name)))
+            lines.append("{}{}_per_second {}".format(prefix, rate_name(name), meter.rate()))
+        for (name, labels), value in sorted(self.counters.items()):
+            lines.append("{}{}{} {}".format(prefix, name, fmt_labels(labels), value))
+        for (name, labels), h in sorted(self.histograms.items()):
+            cumulative = 0
+            for bound, n in zip(BUCKETS, h.counts):
+                cumulative += n
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append("{}{}_bucket{} {}".format(prefix, name, fmt_labels(labels + (("le", le),)), cumulative))
+            lines.append("{}{}_sum{} {}".format(prefix, name, fmt_labels(labels), h.sum))
+            lines.append("{}{}_count{} {}".format(prefix, name, fmt_labels(labels), h.count))
+        return "\n".join(lines) + "\n"
+
+    async def serve(self, host="127.0.0.1", port=9108):
+        '''Serve prometheus() over plain HTTP to any GET. Meant for a local scraper, so there is no TLS or auth'''
+        async def handle(reader, writer):
+            try:
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                body = self.prometheus().encode("utf-8")
+                writer.write(b"HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: " +
+                             str(len(body)).encode("ascii") + b"\r\n\r\n" + body)
+                await writer.drain()
+            finally:
+                writer.close()
+        return await asyncio.start_server(handle, host, port)
+
+def rate_name(name):
+    return name[:-len("_total")] if name.endswith("_total") else name
+
+def fmt_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, v) for k, v in labels) + "}"
+
+def fmt_seconds(seconds):
+    return "{:.1f}ms".format(seconds * 1000) if seconds < 1 else "{:.2f}s".format(seconds)
+
+def fmt_number(value):
+    return "{:.3f}".format(value) if isinstance(value, float) else str(value)
+
+METRICS = Metrics() # Shared by the bot, the renderer and matches
@@ -0,0 +1,65 @@
+import gzip, json, os, time, zlib
+from collections import deque
+
+class MessageLog():
+    '''Log of every update received, kept on disk as rotated, gzip-compressed NDJSON segments
+    Only the most recent messages stay in memory. Older ones are streamed back with read().'''
+    def __init__(self, directory='msglog', segment_bytes=4*1024*1024, segment_seconds=24*60*60, tail=100):
+        self.directory = directory
+        self.segment_bytes = segment_bytes # Rotate once a segment is this large on disk...
+        self.segment_seconds = segment_seconds # ... or this old
+        self.tail = deque(maxlen=tail) # Most recent messages, newest last
+        self.pending = [] # Encoded messages not yet written out
+        self.segment = None # Path of the segment being written
+        self.segment_started = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def append(self, msg):
+        '''Log a message, it reaches the disk on the next flush'''
+        self.tail.append(msg)
+        self.pending.append(json.dumps(msg, separators=(',', ':')))
+
+    def take(self):
+        '''Hand over the queued messages, for write() on another thread'''
+        lines, self.pending = self.pending, []
+        return lines
+
+    def flush(self):
+        self.write(self.take())
+
+    def write(self, lines):
+        '''Write messages from take() to the current segment, starting a new one when it is due'''
+        if not lines:
+            return
+        now = time.time()
+        if self.segment is None or now - self.segment_started >= self.segment_seconds or os.path.getsize(self.segment) >= self.segment_bytes:
+            self.rotate(now)
+        # Each flush adds one gzip member; readers see the members as a single stream
+        with gzip.open(self.segment, "ab") as f:
+            f.write(("\n".join(lines) + "\n").encode("utf-8"))
+
+    def rotate(self, now):
+        '''Start a new segment. Names sort in creation order'''
+        name = "{:015d}.ndjson.gz".format(int(now * 1000))
+        while os.path.exists(os.path.join(self.directory, name)):
+            now += 0.001
+            name = "{:015d}.ndjson.gz".format(int(now * 1000))
+        self.segment = os.path.join(self.directory, name)
+        self.segment_started = now
+
+    def segments(self):
+        '''Paths of all segments on disk, oldest first'''
+        return [os.path.join(self.directory, name) for name in sorted(os.listdir(self.directory)) if name.endswith(".ndjson.gz")]
+
+    def read(self):
+        '''Generator over every logged message, oldest first, one segment at a time
+        A segment cut short by a crash yields what survived.'''
+        for path in self.segments():
+            try:
+                with gzip.open(path, "rb") as f:
+                    for line in f:
+                        yield json.loads(line)
+            except (EOFError, OSError, zlib.error, ValueError):
+                continue
+        for line in self.pending:
+            yield json.loads(line)
@@ -0,0 +1,231 @@
+import asyncio, heapq, itertools, logging, time
+from collections import deque
+import telepot
+
+log = logging.getLogger("tgchessbot")
+
+REPLY, NOTICE = 0, 1 # Priorities: answers to what a user just did go out before reminders and other notices
+
+TEXT_LIMIT = 4096 # Longest message Telegram accepts...
+CAPTION_LIMIT = 1024 # ... and longest photo caption
+
+class TokenBucket():
+    '''Allows rate sends per second on average, and bursts of up to burst sends'''
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+        self.paused_until = 0 # Set from Telegram's retry_after
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def wait_time(self, now):
+        '''Seconds until a send is allowed'''
+        self.refill(now)
+        return max(self.paused_until - now, 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate)
+
+    def take(self, now):
+        self.refill(now)
+        self.tokens -= 1
+
+    def idle(self, now):
+        self.refill(now)
+        return self.tokens >= self.burst and now >= self.paused_until
+
+class Outbox():
+    '''Every message to a chat goes through here. Sends are paced by a global and a per-chat token bucket,
+    retried after 429s for as long as Telegram's retry_after asks, and consecutive texts waiting for the same
+    chat are merged into one message or into the caption of a board photo next to them.
+    Messages to one chat keep their order; across chats, replies go before notices.'''
+    def __init__(self, bot, global_rate=30, private_rate=1, group_rate=20/60, burst=3, linger=0.05, attempts=5):
+        self.bot = bot
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.private_rate = private_rate # Sends per second to one private chat...
+        self.group_rate = group_rate # ... and to one group, as Telegram's limits allow
+        self.burst = burst
+        self.linger = linger # Seconds a chat's first message waits for more to merge with
+        self.attempts = attempts # Tries on network errors before giving up on a message
+        self.queues = {} # chat_id -> deque of pending items, while the chat has any
+        self.buckets = {} # chat_id -> TokenBucket
+        self.ready = [] # Heap of (priority, tiebreak, chat_id) of chats whose next item may be sent now
+        self.busy = set() # Chats with an item queued in ready, waiting on their bucket or being sent
+        self.counter = itertools.count()
+        self.wakeup = None
+        self.task = None
+        self.sent, self.merged, self.retried, self.failed = 0, 0, 0, 0
+
+    def pending(self):
+        return sum(len(q) for q in self.queues.values())
+
+    def send_text(self, chat_id, text, priority=REPLY, **kwargs):
+        '''Queue a sendMessage. Returns a future for Telegram's reply, or None if it could not be sent'''
+        return self.submit(chat_id, {"method": "sendMessage", "text": text, "kwargs": kwargs}, priority)
+
+    def send_photo(self, chat_id, image, caption=None, priority=REPLY, **kwargs):
+        '''Queue a sendPhoto of a BoardImage, reusing and recording its file_id'''
+        return self.submit(chat_id, {"method": "sendPhoto", "image": image, "text": caption or "", "kwargs": kwargs}, priority)
+
+    def send_document(self, chat_id, document, priority=REPLY, **kwargs):
+        return self.submit(chat_id, {"method": "sendDocument", "document": document, "kwargs": kwargs}, priority)
+
+    def submit(self, chat_id, item, priority):
+        if self.task is None:
+            self.wakeup = asyncio.Event()
+            self.task = asyncio.ensure_future(self.run())
+        item["priority"] = priority
+        item["futures"] = [asyncio.get_running_loop().create_future()]
+        item["tries"] = 0
+        self.queues.setdefault(chat_id, deque()).append(item)
+        if chat_id not in self.busy:
+            self.busy.add(chat_id)
+            # Give the handler a moment to queue the rest of what it has to say
+            asyncio.get_running_loop().call_later(self.linger, self.make_ready, chat_id)
+        return item["futures"][0]
+
+    def make_ready(self, chat_id):
+        queue = self.queues.get(chat_id)
+        if not queue:
+            self.busy.discard(chat_id)
+            return
+        heapq.heappush(self.ready, (min(item["priority"] for item in queue), next(self.counter), chat_id))
+        self.wakeup.set()
+
+    def bucket(self, chat_id):
+        bucket = self.buckets.get(chat_id)
+        if bucket is None:
+            # Private chats share the user's id, which is positive. Groups are negative
+            rate = self.private_rate if isinstance(chat_id, int) and chat_id > 0 else self.group_rate
+            bucket = self.buckets[chat_id] = TokenBucket(rate, self.burst)
+        return bucket
+
+    def can_merge(self, item, text_item, limit):
+        return (text_item["method"] == "sendMessage" and text_item["kwargs"] == item["kwargs"]
+                and len(item["text"]) + len(text_item["text"]) + 1 <= limit)
+
+    def take(self, chat_id):
+        '''Pop the chat's next item, with the texts around it merged in'''
+        queue = self.queues[chat_id]
+        item = queue.popleft()
+        if item["method"] == "sendMessage":
+            while queue and self.can_merge(item, queue[0], TEXT_LIMIT):
+                self.absorb(item, queue.popleft())
+            # Plain text in front of a board becomes the top of its caption
+            if queue and queue[0]["method"] == "sendPhoto" and not item["kwargs"]:
+                photo = queue[0]
+                if len(item["text"]) + len(photo["text"]) + 1 <= CAPTION_LIMIT and not photo["kwargs"]:
+                    queue.popleft()
+                    photo["text"] = item["text"] + ("\n" + photo["text"] if photo["text"] else "")
+                    photo["futures"] += item["futures"]
+                    photo["priority"] = min(photo["priority"], item["priority"])
+                    self.merged += 1
+                    item = photo
+        if item["method"] == "sendPhoto" and not item["kwargs"]:
+            # ... and plain text after it, the bottom
+            while queue and self.can_merge(item, queue[0], CAPTION_LIMIT):
+                self.absorb(item, queue.popleft())
+        if not queue:
+            del self.queues[chat_id]
+        return item
+
+    def absorb(self, item, other):
+        item["text"] = item["text"] + "\n" + other["text"] if item["text"] else other["text"]
+        item["futures"] += other["futures"]
+        item["priority"] = min(item["priority"], other["priority"])
+        self.merged += 1
+
+    async def run(self):
+        '''Hand out sends as the buckets allow, most urgent chat first'''
+        while 1:
+            if not self.ready:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            now = time.monotonic()
+            wait = self.global_bucket.wait_time(now)
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            priority, tiebreak, chat_id = heapq.heappop(self.ready)
+            wait = self.bucket(chat_id).wait_time(now)
+            if wait > 0:
+                asyncio.get_running_loop().call_later(wait, self.make_ready, chat_id)
+                continue
+            if chat_id not in self.queues:
+                self.busy.discard(chat_id)
+                continue
+            self.global_bucket.take(now)
+            self.bucket(chat_id).take(now)
+            asyncio.ensure_future(self.deliver(chat_id, self.take(chat_id)))
+            if len(self.buckets) > 4 * len(self.busy) + 1024:
+                self.prune(now)
+
+    def prune(self, now):
+        '''Forget the buckets of chats that have gone quiet'''
+        for chat_id, bucket in list(self.buckets.items()):
+            if chat_id not in self.busy and bucket.idle(now):
+                del self.buckets[chat_id]
+
+    async def deliver(self, chat_id, item):
+        '''Send one item. The chat's next item waits until this one is done, so the chat sees them in order'''
+        delay = 0
+        try:
+            result = await self.call(chat_id, item)
+        except telepot.exception.TooManyRequestsError as e:
+            # Put it back in front and hold the chat for as long as Telegram asks
+            delay = (e.json or {}).get("parameters", {}).get("retry_after", 1)
+            self.bucket(chat_id).paused_until = time.monotonic() + delay
+            self.requeue(chat_id, item)
+            self.retried += 1
+            return
+        except telepot.exception.TelegramError:
+            # Refused for good: blocked by the user, kicked from the group, bad markup...
+            log.warning("%s to %s refused", item["method"], chat_id, exc_info = True)
+            self.resolve(item, None)
+            self.failed += 1
+        except Exception:
+            item["tries"] += 1
+            if item["tries"] < self.attempts:
+                delay = 2 ** item["tries"]
+                self.requeue(chat_id, item)
+                self.retried += 1
+                return
+            log.error("%s to %s failed %d times", item["method"], chat_id, item["tries"], exc_info = True)
+            self.resolve(item, None)
+            self.failed += 1
+        else:
+            self.resolve(item, result)
+            self.sent += 1
+        finally:
+            asyncio.get_running_loop().call_later(delay, self.make_ready, chat_id)
+
+    def requeue(self, chat_id, item):
+        self.queues.setdefault(chat_id, deque()).appendleft(item)
+
+    def resolve(self, item, result):
+        for future in item["futures"]:
+            if not future.done():
+                future.set_result(result)
+
+    async def call(self, chat_id, item):
+        bot = self.bot
+        if item["method"] == "sendMessage":
+            return await bot.call(bot.api.sendMessage, chat_id, item["text"], **item["kwargs"])
+        if item["method"] == "sendDocument":
+            name, data = item["document"]
+            data.seek(0)
+            return await bot.call(bot.api.sendDocument, chat_id, (name, data), **item["kwargs"])
+        image = item["image"]
+        if image.file_id is not None:
+            try:
+                return await bot.call(bot.api.sendPhoto, chat_id, image.file_id, caption = item["text"] or None, **item["kwargs"])
+            except telepot.exception.TooManyRequestsError:
+                raise
+            except telepot.exception.TelegramError:
+                # Stale file_id, fall back to uploading the bytes again
+                image.file_id = None
+        sent = await bot.call(bot.api.sendPhoto, chat_id, image.photo(), caption = item["text"] or None, **item["kwargs"])
+        image.file_id = sent["photo"][-1]["file_id"]
+        return sent
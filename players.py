@@ -0,0 +1,197 @@
+import json, sqlite3
+from contextlib import contextmanager
+from ratings import *
+
+class PlayerStore():
+    '''What the bot knows about players across chats: W/D/L stats, Elo ratings, leaderboard names and
+    the active-games index. Kept in memory and saved in the bot's snapshots.
+    SharedPlayerStore keeps the same in a database file used by several processes at once.'''
+    shared = False
+
+    def __init__(self):
+        self.statslog = {} # Player id -> stats [W, D, L]
+        self.active_games = {} # Player id -> set of chat ids where that player has an ongoing match
+        self.ratings = RatingIndex() # Elo ratings, ranks and leaderboard
+        self.player_names = {} # Rated player id -> name from their latest game, for the leaderboard
+
+    def index_game(self, pid, chat_id):
+        self.active_games.setdefault(pid, set()).add(chat_id)
+
+    def unindex_game(self, pid, chat_id):
+        chats = self.active_games.get(pid)
+        if chats:
+            chats.discard(chat_id)
+            if not chats:
+                del self.active_games[pid]
+
+    def games(self, pid):
+        '''Chat ids of the player's ongoing matches'''
+        return sorted(self.active_games.get(pid, ()), key = str)
+
+    def set_status(self, chat_id, status):
+        '''Every match is in this process, so /games reads them directly and there is nothing to publish'''
+        pass
+
+    def clear_status(self, chat_id):
+        pass
+
+    def status(self, chat_id):
+        return None
+
+    def record_result(self, game, white, black, winner, rated):
+        '''Count a finished game. white and black are [id, name], game identifies it, rated says whether ratings change'''
+        # Update player stats [W, D, L]
+        white_stats = self.statslog.setdefault(white[0], [0,0,0])
+        black_stats = self.statslog.setdefault(black[0], [0,0,0])
+        if winner == "White":
+            white_stats[0] += 1
+            black_stats[2] += 1
+        elif winner == "Black":
+            white_stats[2] += 1
+            black_stats[0] += 1
+        elif winner == "Draw":
+            white_stats[1] += 1
+            black_stats[1] += 1
+        if rated:
+            self.ratings.record_game(white[0], black[0], {"White": 1, "Black": 0, "Draw": 0.5}[winner])
+            self.player_names[white[0]], self.player_names[black[0]] = white[1], black[1]
+
+    def stats(self, pid):
+        '''[W, D, L], or None before the player's first finished game'''
+        return self.statslog.get(pid)
+
+    def rating(self, pid):
+        return self.ratings.get(pid)
+
+    def rank(self, pid):
+        '''Position on the leaderboard, None until the player's first rated game'''
+        return self.ratings.rank(pid) if pid in self.ratings else None
+
+    def rated_count(self):
+        return len(self.ratings)
+
+    def top(self, n):
+        '''The n highest rated players as [(pid, name, rating)], best first'''
+        return [(pid, self.player_names.get(pid, pid), rating) for pid, rating in self.ratings.top(n)]
+
+    def dump(self):
+        return {"statslog": [[pid, list(stats)] for pid, stats in self.statslog.items()],
+                "active_games": [[pid, list(chats)] for pid, chats in self.active_games.items()],
+                "ratings": self.ratings.dump(),
+                "player_names": [[pid, name] for pid, name in self.player_names.items()]}
+
+    def restore(self, state):
+        '''Load what state has of a dump(). Returns False if it lacks the active-games index, which must then be rebuilt'''
+        if "statslog" in state:
+            self.statslog = dict((pid, stats) for pid, stats in state["statslog"])
+        self.ratings.restore(state.get("ratings", []))
+        self.player_names = dict((pid, name) for pid, name in state.get("player_names", []))
+        if "active_games" not in state:
+            return False
+        self.active_games = dict((pid, set(chats)) for pid, chats in state["active_games"])
+        return True
+
+    def close(self):
+        pass
+
+class SharedPlayerStore():
+    '''PlayerStore in an SQLite file that several bot processes, e.g. the workers of shards.py, use at once
+    Every change is its own transaction, so the file is always current and nothing goes into snapshots. Each
+    process replays its own journal on restart, so recording a game's result twice is ignored. Also publishes
+    each match's status, so /games can describe matches living in other processes.'''
+    shared = True
+
+    def __init__(self, path, initial=1200, k=32, timeout=30):
+        self.initial = initial # Same Elo settings as RatingIndex
+        self.k = k
+        # Transactions are managed by hand, see transaction()
+        self.db = sqlite3.connect(path, timeout = timeout, isolation_level = None)
+        self.db.execute("PRAGMA journal_mode=WAL") # Readers never wait for the writer
+        self.db.execute("PRAGMA synchronous=NORMAL") # Each process's journal already makes its changes durable
+        with self.transaction():
+            self.db.execute("CREATE TABLE IF NOT EXISTS stats (pid INTEGER PRIMARY KEY, wins INTEGER NOT NULL DEFAULT 0, "
+                            "draws INTEGER NOT NULL DEFAULT 0, losses INTEGER NOT NULL DEFAULT 0)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS ratings (pid INTEGER PRIMARY KEY, rating REAL NOT NULL, name TEXT)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS ratings_by_rating ON ratings (rating)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS active (pid INTEGER NOT NULL, chat TEXT NOT NULL, PRIMARY KEY (pid, chat))")
+            self.db.execute("CREATE TABLE IF NOT EXISTS status (chat TEXT PRIMARY KEY, status TEXT NOT NULL)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS results (game TEXT PRIMARY KEY)")
+
+    @contextmanager
+    def transaction(self):
+        '''Take the write lock up front, so read-modify-write sequences cannot interleave between processes'''
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("COMMIT")
+
+    def index_game(self, pid, chat_id):
+        self.db.execute("INSERT OR IGNORE INTO active VALUES (?, ?)", (pid, json.dumps(chat_id)))
+
+    def unindex_game(self, pid, chat_id):
+        self.db.execute("DELETE FROM active WHERE pid = ? AND chat = ?", (pid, json.dumps(chat_id)))
+
+    def games(self, pid):
+        return sorted((json.loads(chat) for chat, in self.db.execute("SELECT chat FROM active WHERE pid = ?", (pid,))), key = str)
+
+    def set_status(self, chat_id, status):
+        self.db.execute("INSERT OR REPLACE INTO status VALUES (?, ?)", (json.dumps(chat_id), json.dumps(status)))
+
+    def clear_status(self, chat_id):
+        self.db.execute("DELETE FROM status WHERE chat = ?", (json.dumps(chat_id),))
+
+    def status(self, chat_id):
+        row = self.db.execute("SELECT status FROM status WHERE chat = ?", (json.dumps(chat_id),)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def record_result(self, game, white, black, winner, rated):
+        columns = {"White": ("wins", "losses"), "Black": ("losses", "wins"), "Draw": ("draws", "draws")}.get(winner)
+        with self.transaction():
+            if not self.db.execute("INSERT OR IGNORE INTO results VALUES (?)", (game,)).rowcount:
+                # Already counted before a restart
+                return
+            for pid, i in ((white[0], 0), (black[0], 1)):
+                if pid != None:
+                    self.db.execute("INSERT OR IGNORE INTO stats (pid) VALUES (?)", (pid,))
+                    if columns:
+                        self.db.execute("UPDATE stats SET {0} = {0} + 1 WHERE pid = ?".format(columns[i]), (pid,))
+            if rated:
+                ratings = elo(self.rating(white[0]), self.rating(black[0]), {"White": 1, "Black": 0, "Draw": 0.5}[winner], self.k)
+                for (pid, name), rating in zip((white, black), ratings):
+                    # A NULL pid would make SQLite pick a fresh one, adding a player who does not exist
+                    if pid != None:
+                        self.db.execute("INSERT OR REPLACE INTO ratings VALUES (?, ?, ?)", (pid, rating, name))
+
+    def stats(self, pid):
+        row = self.db.execute("SELECT wins, draws, losses FROM stats WHERE pid = ?", (pid,)).fetchone()
+        return list(row) if row else None
+
+    def rating(self, pid):
+        row = self.db.execute("SELECT rating FROM ratings WHERE pid = ?", (pid,)).fetchone()
+        return row[0] if row else self.initial
+
+    def rank(self, pid):
+        '''Players in the same whole-point bucket share a rank, as with RatingIndex'''
+        row = self.db.execute("SELECT rating FROM ratings WHERE pid = ?", (pid,)).fetchone()
+        if row is None:
+            return None
+        return self.db.execute("SELECT COUNT(*) FROM ratings WHERE rating >= ?", (round(row[0]) + 0.5,)).fetchone()[0] + 1
+
+    def rated_count(self):
+        return self.db.execute("SELECT COUNT(*) FROM ratings").fetchone()[0]
+
+    def top(self, n):
+        return [(pid, name if name is not None else pid, rating)
+                for pid, rating, name in self.db.execute("SELECT pid, rating, name FROM ratings ORDER BY rating DESC LIMIT ?", (n,))]
+
+    def dump(self):
+        return {}
+
+    def restore(self, state):
+        return True
+
+    def close(self):
+        self.db.close()
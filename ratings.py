@@ -0,0 +1,91 @@
+def elo(white, black, score, k):
+    '''Both players' new ratings after a game. score is White's result: 1, 0.5 or 0'''
+    expected = 1 / (1 + 10 ** ((black - white) / 400))
+    return white + k * (score - expected), black - k * (score - expected)
+
+class RatingIndex():
+    '''Elo ratings of every player, with ranks and leaderboards answered without sorting
+    Ratings are bucketed by whole points and a Fenwick tree counts players per bucket,
+    so rank lookups and rating changes cost O(log range) however many players there are.'''
+    def __init__(self, initial=1200, k=32, lowest=0, highest=4000):
+        self.initial = initial # Rating of a player's first rated game
+        self.k = k # Elo K-factor
+        self.lowest, self.highest = lowest, highest
+        self.ratings = {} # pid -> rating
+        self.buckets = {} # whole-point rating -> set of pids
+        self.tree = [0] * (highest - lowest + 2) # Fenwick tree of bucket sizes, 1-based
+
+    def __len__(self):
+        return len(self.ratings)
+
+    def __contains__(self, pid):
+        return pid in self.ratings
+
+    def bucket(self, rating):
+        return min(max(int(round(rating)), self.lowest), self.highest)
+
+    def add(self, bucket, delta):
+        i = bucket - self.lowest + 1
+        while i < len(self.tree):
+            self.tree[i] += delta
+            i += i & -i
+
+    def count_upto(self, bucket):
+        '''Number of players whose bucket is <= bucket'''
+        i, total = bucket - self.lowest + 1, 0
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+    def find(self, k):
+        '''Bucket holding the k-th lowest rated player, 1-based'''
+        i, step = 0, 1 << (len(self.tree).bit_length())
+        while step:
+            if i + step < len(self.tree) and self.tree[i + step] < k:
+                i += step
+                k -= self.tree[i]
+            step >>= 1
+        return i + self.lowest
+
+    def get(self, pid):
+        return self.ratings.get(pid, self.initial)
+
+    def set(self, pid, rating):
+        if pid in self.ratings:
+            old = self.bucket(self.ratings[pid])
+            self.buckets[old].discard(pid)
+            if not self.buckets[old]:
+                del self.buckets[old]
+            self.add(old, -1)
+        self.ratings[pid] = rating
+        new = self.bucket(rating)
+        self.buckets.setdefault(new, set()).add(pid)
+        self.add(new, 1)
+
+    def rank(self, pid):
+        '''1 + number of players rated strictly higher. Players in the same whole-point bucket share a rank'''
+        return len(self.ratings) - self.count_upto(self.bucket(self.ratings[pid])) + 1
+
+    def top(self, n):
+        '''The n highest rated players as [(pid, rating)], best first'''
+        result, k = [], len(self.ratings)
+        while k > 0 and len(result) < n:
+            bucket = self.find(k)
+            pids = sorted(self.buckets[bucket], key=lambda pid: -self.ratings[pid])
+            result.extend((pid, self.ratings[pid]) for pid in pids)
+            k -= len(pids)
+        return result[:n]
+
+    def record_game(self, white_id, black_id, score):
+        '''Update both ratings after a game. score is White's result: 1, 0.5 or 0'''
+        white, black = elo(self.get(white_id), self.get(black_id), score, self.k)
+        self.set(white_id, white)
+        self.set(black_id, black)
+
+    def dump(self):
+        return [[pid, rating] for pid, rating in self.ratings.items()]
+
+    def restore(self, ratings):
+        for pid, rating in ratings:
+            self.set(pid, rating)
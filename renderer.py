@@ -1,26 +1,42 @@
-import re
+import re, io, threading
+from collections import OrderedDict
 from PIL import Image, ImageDraw, ImageFont, ImageFilter
+from metrics import METRICS
 # Chess piece images: https://en.wikipedia.org/wiki/Chess_piece
 # Attribution: By en:User:Cburnett - Own work. This vector image was created with Inkscape., CC BY-SA 3.0
 
-class Renderer():
-	'''Renderer class that will convert chess positions to images'''
-	
-	def __init__(self, turn=True):
-		'''Pre-draw an empty board and pre-load the pieces'''
-		self.turn = turn
-		self.grid_size = (40,40)
-		self.board = self.draw_empty_board()
-		self.piece_locations = './pieces'
+def grid_to_coords(grid, grid_size):
+	coords = [grid[i] * grid_size[i] for i in range(2)] * 2
+	coords[2] += grid_size[0]
+	coords[3] += grid_size[1]
+	return coords
+
+# Modified from http://wordaligned.org/articles/drawing-chess-positions
+def expand_fen(fen):
+	'''Expand the digits in an FEN string into spaces
+	E.g. 'rk4q3' becoes 'rk    q   '
+	'''
+	def expand(match):
+		return ' ' * int(match.group(0))
+	return re.compile(r'\d').sub(expand, fen).replace('/','')
+
+class RenderAssets():
+	'''Immutable drawing assets shared by every Renderer in the process
+	Holds the empty boards for both orientations, the resized pieces with their alpha masks
+	and a pre-composited tile for every piece on every square of the 8x8 board.
+	Nothing in here may be modified after construction; renderers copy before drawing.'''
+
+	def __init__(self, grid_size=(40,40), piece_locations='./pieces', font_location='./fonts/Helvetica Bold.ttf'):
+		self.grid_size = grid_size
+		self.piece_locations = piece_locations
+		self.font = ImageFont.truetype(font_location, 20)
+		self.squares = [(r,c) for c in range(1,9) for r in range(1,9)]
+		self.coords = dict((sq, grid_to_coords(sq, self.grid_size)) for sq in self.squares)
+		self.boards = dict((turn, self.draw_empty_board(turn)) for turn in (True, False))
 		self.pieces, self.masks = self.load_pieces()
+		self.tiles = self.compose_tiles()
 
-	def grid_to_coords(self, grid):
-		coords = [grid[i] * self.grid_size[i] for i in range(2)] * 2
-		coords[2] += self.grid_size[0]
-		coords[3] += self.grid_size[1]
-		return coords
- 
-	def draw_empty_board(self):
+	def draw_empty_board(self, turn):
 		'''Draws an empty 8x8 board with axis labels
 		Coordinate wise, we are going to draw a 10x10 grid, with the 8x8 board inside'''
 
@@ -32,7 +48,7 @@ class Renderer():
 		grey_color = 175
 		black_cells = [(r,c) if r % 2 == 0 else (r,c+1) for r in range(1,9) for c in range(1,9,2)]
 		for bc in black_cells:
-			ImageDraw.Draw(board).rectangle(self.grid_to_coords(bc), fill = grey_color)
+			ImageDraw.Draw(board).rectangle(self.coords[bc], fill = grey_color)
 
 		# Draw black outline for board
 		ImageDraw.Draw(board).line([self.grid_size[0], self.grid_size[1], 9 * self.grid_size[0], self.grid_size[1]], width=2)
@@ -42,13 +58,12 @@ class Renderer():
 
 		# Write down axis
 		letters = ['a', 'b', 'c', 'd', 'e', 'f', 'g', 'h']
-		letters = letters if self.turn else letters[::-1]
-		axes = [[str((9-i if self.turn else i)), j * self.grid_size[0], i * self.grid_size[1]] for i in range(1,9) for j in [0,9]]
+		letters = letters if turn else letters[::-1]
+		axes = [[str((9-i if turn else i)), j * self.grid_size[0], i * self.grid_size[1]] for i in range(1,9) for j in [0,9]]
 		axes += [[letters[i-1], i * self.grid_size[0], j * self.grid_size[1]] for i in range(1,9) for j in [0,9]]
-		font = ImageFont.truetype("./fonts/Helvetica Bold.ttf", 20)
 		for [txt, x, y] in axes:
 			# Add __ * self.grid_size to try to center the text
-			ImageDraw.Draw(board).text((x + 0.35*self.grid_size[0], y + 0.35*self.grid_size[1]), txt, font=font)
+			ImageDraw.Draw(board).text((x + 0.35*self.grid_size[0], y + 0.35*self.grid_size[1]), txt, font=self.font)
 
 		return board
 
@@ -62,28 +77,142 @@ class Renderer():
 		piece_masks = dict((piece, img.split()[3]) for piece, img in piece_images.items())
 		return piece_images, piece_masks
 
-	# Modified from http://wordaligned.org/articles/drawing-chess-positions
+	def compose_tiles(self):
+		'''Pre-composites every piece onto every square
+		Tiles are cut per square rather than per square colour so the board outline along the edges survives the paste.
+		The inner 8x8 area is identical for both orientations, so one set of tiles serves both.'''
+		tiles = {}
+		board = self.boards[True]
+		for sq, coords in self.coords.items():
+			tiles[' ', sq] = board.crop(coords)
+			for p, img in self.pieces.items():
+				tile = board.crop(coords)
+				tile.paste(img, (0, 0), self.masks[p])
+				tiles[p, sq] = tile
+		return tiles
+
+_assets = None
+_assets_lock = threading.Lock()
+
+def get_assets():
+	'''Returns the process-wide render assets, building them on first use'''
+	global _assets
+	if _assets is None:
+		with _assets_lock:
+			if _assets is None:
+				_assets = RenderAssets()
+	return _assets
+
+@METRICS.timer("jpeg_encode_seconds")
+def encode_jpeg(image, quality=75):
+	'''Encodes a rendered board into JPEG bytes without touching the disk'''
+	buf = io.BytesIO()
+	image.save(buf, "JPEG", quality=quality)
+	return buf.getvalue()
+
+class BoardImage():
+	'''An encoded board image, plus the Telegram file_id once it has been uploaded'''
+	def __init__(self, data):
+		self.data = data
+		self.file_id = None
+
+	def photo(self):
+		'''Returns what to hand to sendPhoto: the file_id if Telegram already has it, else the bytes'''
+		if self.file_id is not None:
+			return self.file_id
+		return ('board.jpg', io.BytesIO(self.data))
+
+class BoardImageCache():
+	'''Bounded LRU cache of encoded boards keyed by (board FEN, orientation)'''
+	def __init__(self, maxsize=1024):
+		self.maxsize = maxsize
+		self.images = OrderedDict()
+		self.lock = threading.Lock()
+		self.hits, self.misses = 0, 0
+
+	def get(self, key):
+		'''Returns the cached BoardImage for key, or None'''
+		with self.lock:
+			image = self.images.get(key)
+			if image is None:
+				self.misses += 1
+			else:
+				self.hits += 1
+				self.images.move_to_end(key)
+			return image
+
+	def put(self, key, data):
+		'''Stores freshly encoded bytes for key, evicting the least recently used entries'''
+		with self.lock:
+			image = self.images.get(key)
+			if image is None:
+				image = self.images[key] = BoardImage(data)
+				while len(self.images) > self.maxsize:
+					self.images.popitem(last=False)
+			self.images.move_to_end(key)
+			return image
+
+class Renderer():
+	'''Renderer class that will convert chess positions to images'''
+	
+	def __init__(self, turn=True):
+		'''Picks up the shared empty board and pieces for this orientation'''
+		self.turn = turn
+		self.assets = get_assets()
+		self.grid_size = self.assets.grid_size
+		self.board = self.assets.boards[turn]
+		self.pieces, self.masks = self.assets.pieces, self.assets.masks
+
+	def grid_to_coords(self, grid):
+		return grid_to_coords(grid, self.grid_size)
+
 	def expand_fen(self, fen):
-		'''Expand the digits in an FEN string into spaces
-		E.g. 'rk4q3' becoes 'rk    q   '
-		'''
-		def expand(match):
-			return ' ' * int(match.group(0))
-		return re.compile(r'\d').sub(expand, fen).replace('/','')
+		return expand_fen(fen)
 
+	@METRICS.timer("draw_fen_seconds", renderer="full")
 	def draw_fen(self, fen):
 		'''Draws a chess board position from a given FEN chess position'''
 		# Replace numbers in fen with spaces
-		print(fen)
 		fen = fen if self.turn else fen[::-1]
-		points = filter(lambda x: x[0] != ' ',
-			[(p, pt) for (p, pt) in zip(self.expand_fen(fen),
-										[(r,c) for c in range(1,9) for r in range(1,9)])])
-		board = self.board # Get empty board
-		for (p, pt) in points:
-			board.paste(self.pieces[p], self.grid_to_coords(pt), self.masks[p])
+		board = self.board.copy() # Get empty board
+		for (p, pt) in zip(self.expand_fen(fen), self.assets.squares):
+			if p != ' ':
+				board.paste(self.assets.tiles[p, pt], self.assets.coords[pt])
 		return board
 
+class IncrementalRenderer():
+	'''Per-match renderer that keeps the last frame drawn for each orientation
+	Only squares whose occupant changed since that frame are repainted. As the board is drawn from the
+	mover's perspective, consecutive moves alternate between the two frames.'''
+
+	def __init__(self):
+		self.assets = get_assets()
+		self.frames = {} # turn -> [image, expanded placement in drawing order]
+		self.lock = threading.Lock() # Frames are shared by render workers
+
+	@METRICS.timer("draw_fen_seconds", renderer="incremental")
+	def draw_fen(self, fen, turn):
+		'''Draws the position, returning this orientation's frame
+		The frame is reused by the next call, so encode or copy it before rendering again.'''
+		placement = expand_fen(fen if turn else fen[::-1])
+		if turn not in self.frames:
+			# First render in this orientation, draw everything
+			self.frames[turn] = [Renderer(turn).draw_fen(fen), placement]
+			return self.frames[turn][0]
+
+		frame, previous = self.frames[turn]
+		tiles, coords, squares = self.assets.tiles, self.assets.coords, self.assets.squares
+		for i in range(64):
+			if placement[i] != previous[i]:
+				frame.paste(tiles[placement[i], squares[i]], coords[squares[i]])
+		self.frames[turn][1] = placement
+		return frame
+
+	def render_jpeg(self, fen, turn, options=None):
+		'''Draws and encodes the position while holding the frames'''
+		with self.lock:
+			return encode_jpeg(self.draw_fen(fen, turn), **(options or {}))
+
 ###############
 # For testing #
 ###############
@@ -0,0 +1,45 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from renderer import *
+
+class RenderPoolFull(Exception):
+    '''Raised when too many renders are already waiting for a worker'''
+    pass
+
+def render_jpeg(fen, turn, options=None):
+    '''Full render and encode of a position. Runs inside pool workers, so it must stay picklable'''
+    return encode_jpeg(Renderer(turn).draw_fen(fen), **(options or {}))
+
+class RenderPool():
+    '''Renders and encodes boards on worker threads or processes instead of the event loop'''
+    def __init__(self, size=2, mode='thread', max_pending=64, options=None):
+        '''mode is 'thread' or 'process'. At most max_pending renders may be queued or running at once'''
+        if mode == 'process':
+            self.executor = ProcessPoolExecutor(size)
+        elif mode == 'thread':
+            self.executor = ThreadPoolExecutor(size)
+        else:
+            raise ValueError("Unknown render pool mode: {}".format(mode))
+        self.mode = mode
+        self.options = options or {}
+        self.slots = asyncio.Semaphore(max_pending)
+
+    async def render(self, fen, turn, frames=None, timeout=None):
+        '''Render (fen, turn) on the pool and return the JPEG bytes
+        Waits while the pool is saturated and raises RenderPoolFull once timeout expires.
+        Threads can reuse the match's IncrementalRenderer; processes always do a full render.'''
+        try:
+            await asyncio.wait_for(self.slots.acquire(), timeout)
+        except asyncio.TimeoutError:
+            raise RenderPoolFull()
+        try:
+            if frames is not None and self.mode == 'thread':
+                future = self.executor.submit(frames.render_jpeg, fen, turn, self.options)
+            else:
+                future = self.executor.submit(render_jpeg, fen, turn, self.options)
+            return await asyncio.wrap_future(future)
+        finally:
+            self.slots.release()
+
+    def shutdown(self):
+        self.executor.shutdown()
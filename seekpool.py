@@ -0,0 +1,65 @@
+from collections import OrderedDict
+
+class SeekPool():
+    '''Players waiting for an opponent, indexed by time control and rating band
+    Bands have a fixed width and a seek only ever accepts opponents within max_reach points,
+    so finding an opponent looks at a bounded number of bands however many players are waiting.
+    The points a seek accepts widen the longer it waits, from reach up to max_reach.'''
+    def __init__(self, band=50, reach=100, widen=5, max_reach=600, sweep_every=5):
+        self.band = band # Width of a rating band in points
+        self.reach = reach # Rating difference a fresh seek accepts...
+        self.widen = widen # ... growing by this many points per second of waiting...
+        self.max_reach = max_reach # ... up to this
+        self.sweep_every = sweep_every # Seconds between passes pairing seeks whose reach has grown
+        self.seeks = OrderedDict() # pid -> seek, oldest first
+        self.bands = {} # (control, band) -> OrderedDict of the pids seeking there, oldest first
+
+    def __len__(self):
+        return len(self.seeks)
+
+    def __contains__(self, pid):
+        return pid in self.seeks
+
+    def key(self, seek):
+        return (tuple(seek["control"]) if seek["control"] else None, int(seek["rating"] // self.band))
+
+    def add(self, seek):
+        '''seek is a dict with pid, name, rating, control ([base, increment] or None) and time'''
+        self.remove(seek["pid"])
+        self.seeks[seek["pid"]] = seek
+        self.bands.setdefault(self.key(seek), OrderedDict())[seek["pid"]] = None
+
+    def remove(self, pid):
+        seek = self.seeks.pop(pid, None)
+        if seek is not None:
+            key = self.key(seek)
+            del self.bands[key][pid]
+            if not self.bands[key]:
+                del self.bands[key]
+
+    def reach_of(self, seek, now):
+        return min(self.reach + self.widen * max(now - seek["time"], 0), self.max_reach)
+
+    def find(self, pid, now):
+        '''Opponent for pid's seek, or None: the nearest band first, and the longest waiting seek within a band
+        Only a band's oldest seek is considered. It has waited longest, so it accepts the most.'''
+        seek = self.seeks[pid]
+        control, centre = self.key(seek)
+        reach = self.reach_of(seek, now)
+        for offset in range(int(self.max_reach // self.band) + 2):
+            for band in ((centre,) if offset == 0 else (centre - offset, centre + offset)):
+                for other_pid in self.bands.get((control, band), ()):
+                    if other_pid == pid:
+                        continue
+                    other = self.seeks[other_pid]
+                    if abs(other["rating"] - seek["rating"]) <= max(reach, self.reach_of(other, now)):
+                        return other_pid
+                    break
+        return None
+
+    def dump(self):
+        return list(self.seeks.values())
+
+    def restore(self, seeks):
+        for seek in seeks:
+            self.add(seek)
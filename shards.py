@@ -0,0 +1,223 @@
+import asyncio, json, logging, multiprocessing, os, secrets, sys, threading, time, zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import telepot
+import tgchessbot
+from tgchessbot import tgchessBot
+from botapi import BotAPI
+from outbox import Outbox
+from players import SharedPlayerStore
+from renderer import get_assets
+from webhook import WebhookServer
+
+log = logging.getLogger("tgchessbot")
+
+def shard_key(update):
+    '''What tgchessBot.feed queues an update behind: its chat, or its sender outside chats'''
+    if "message" in update:
+        return update["message"]["chat"]["id"]
+    for kind in ("callback_query", "inline_query", "chosen_inline_result"):
+        if kind in update:
+            return update[kind]["from"]["id"]
+    return None
+
+def shard_of(update, shards):
+    '''Index of the worker owning the update's chat. Stable across restarts, unlike hash()'''
+    return zlib.crc32(str(shard_key(update)).encode("utf-8")) % shards
+
+def shard_dir(directory, shard):
+    return os.path.join(directory, "shard{}".format(shard))
+
+class ShardFront():
+    '''Runs a bot as several worker processes, each owning the chats that shard_of() gives it
+    This process only receives updates, by long polling or a WebhookServer, and passes them on. Every worker is a
+    whole tgchessBot with its own journal, matches, message log and archive under directory/shard<i>, so a
+    match is only ever touched by one process. Stats, ratings and the /games index are shared through
+    directory/players.db, see SharedPlayerStore, and /history reads the other shards' archives too.
+    A worker that dies is started again and reloads its shard; the updates it had not yet taken are sent again.
+    /seek is turned off, as the two players' private chats generally belong to different workers.'''
+    def __init__(self, token, shards, directory="shards", api_url=None, options=None, outbox=None, save_interval=1, api_workers=2):
+        self.token = token
+        self.shards = shards
+        self.directory = directory
+        self.api_url = api_url
+        self.api = BotAPI(token, api_url) if api_url else telepot.Bot(token)
+        self.api_pool = ThreadPoolExecutor(api_workers)
+        self.options = options or {} # tgchessBot keyword arguments for every worker
+        # Telegram's limit on sends per second is for the bot as a whole, so the workers split it
+        self.outbox = outbox if outbox is not None else {"global_rate": 30 / shards}
+        self.save_interval = save_interval
+        self.context = multiprocessing.get_context("spawn") # Workers must not inherit this process's threads
+        self.workers = [None] * shards
+        self.queues = [None] * shards
+        self.taken = [self.context.Value("q", -1, lock = False) for i in range(shards)] # Last update_id each worker read
+        self.ready = [self.context.Event() for i in range(shards)] # Set once each worker has loaded its shard
+        self.unacked = [deque() for i in range(shards)] # Updates sent to each worker and not yet read by it
+        self.started = [0] * shards
+        self.restarts = 0
+        self.check_layout()
+
+    # Polling, webhooks and API calls work here as they do in a single bot
+    call = tgchessBot.call
+    poll_updates = tgchessBot.poll_updates
+    set_webhook = tgchessBot.set_webhook
+
+    def check_layout(self):
+        '''Refuse to run with a different number of shards than the data was written with, which would strand chats'''
+        os.makedirs(self.directory, exist_ok = True)
+        path = os.path.join(self.directory, "shards.json")
+        if os.path.exists(path):
+            with open(path) as f:
+                shards = json.load(f)["shards"]
+            if shards != self.shards:
+                raise ValueError("{} holds {} shards, not {}".format(self.directory, shards, self.shards))
+        else:
+            with open(path, "w") as f:
+                json.dump({"shards": self.shards}, f)
+
+    def start_worker(self, shard):
+        # A queue is not safe to reuse after its reader died, it may have held the queue's lock
+        if self.queues[shard] is not None:
+            self.queues[shard].cancel_join_thread()
+            self.queues[shard].close()
+        self.queues[shard] = self.context.Queue()
+        self.ready[shard].clear()
+        peers = [os.path.join(shard_dir(self.directory, i), "archive") for i in range(self.shards) if i != shard]
+        self.workers[shard] = self.context.Process(target = run_worker, name = "shard{}".format(shard), daemon = True,
+                                                   args = (self.token, self.api_url, shard_dir(self.directory, shard), peers,
+                                                           os.path.join(self.directory, "players.db"), self.options, self.outbox,
+                                                           self.save_interval, self.queues[shard], self.taken[shard], self.ready[shard]))
+        self.workers[shard].start()
+        self.started[shard] = time.monotonic()
+        for update in self.unacked[shard]:
+            self.queues[shard].put(update)
+
+    def supervise(self):
+        '''Restart workers that died, at most once a second each'''
+        for shard, worker in enumerate(self.workers):
+            if not worker.is_alive() and time.monotonic() - self.started[shard] >= 1:
+                log.warning("Shard %d exited with %s, restarting it", shard, worker.exitcode)
+                self.restarts += 1
+                self.start_worker(shard)
+
+    async def wait_ready(self):
+        '''Wait until every worker is taking updates'''
+        while not all(ready.is_set() for ready in self.ready):
+            await asyncio.sleep(0.05)
+
+    def acknowledge(self, shard):
+        unacked, taken = self.unacked[shard], self.taken[shard].value
+        while unacked and unacked[0]["update_id"] <= taken:
+            unacked.popleft()
+
+    def pending(self):
+        '''Updates sent to workers and not yet read by them'''
+        for shard in range(self.shards):
+            self.acknowledge(shard)
+        return sum(len(unacked) for unacked in self.unacked)
+
+    def feed(self, update):
+        shard = shard_of(update, self.shards)
+        self.acknowledge(shard)
+        self.unacked[shard].append(update)
+        self.queues[shard].put(update)
+
+    def start(self):
+        '''Start the workers. run_forever() does this if it has not been done'''
+        if self.workers[0] is None:
+            for shard in range(self.shards):
+                self.start_worker(shard)
+            log.info("Started %d shards", self.shards)
+
+    async def run_forever(self, poll_timeout=20, webhook=None):
+        '''Pass updates to the workers until cancelled'''
+        self.start()
+        if webhook is None:
+            task = asyncio.ensure_future(self.poll_updates(poll_timeout))
+        else:
+            await webhook.start()
+        try:
+            while 1:
+                await asyncio.sleep(1)
+                self.supervise()
+        finally:
+            if webhook is None:
+                task.cancel()
+            else:
+                webhook.stop()
+
+    def close(self, timeout=10):
+        '''Have the workers finish what they took, save and exit'''
+        for queue in self.queues:
+            if queue is not None:
+                queue.put(None)
+        deadline = time.monotonic() + timeout
+        for worker in self.workers:
+            if worker is not None:
+                worker.join(max(0, deadline - time.monotonic()))
+                if worker.is_alive():
+                    worker.terminate()
+        self.api_pool.shutdown(wait = False)
+
+def run_worker(token, api_url, directory, peers, players, options, outbox, save_interval, queue, taken, ready):
+    '''Body of a worker process: one tgchessBot fed from queue, which ends with None'''
+    logging.basicConfig(level = logging.INFO, format = "%(asctime)s %(levelname)s %(processName)s: %(message)s")
+    get_assets()
+    bot = tgchessBot(token, api = BotAPI(token, api_url) if api_url else None, data_dir = directory, archive_peers = peers,
+                     players = SharedPlayerStore(players), matchmaking = False, **options)
+    bot.outbox = Outbox(bot, **outbox)
+    bot.load_state()
+    asyncio.run(serve_shard(bot, queue, taken, ready, save_interval))
+
+async def serve_shard(bot, queue, taken, ready, save_interval):
+    loop = asyncio.get_running_loop()
+    stopping = asyncio.Event()
+    def receive():
+        while 1:
+            update = queue.get()
+            if update is None:
+                loop.call_soon_threadsafe(stopping.set)
+                return
+            loop.call_soon_threadsafe(bot.feed, update)
+            taken.value = update["update_id"]
+    threading.Thread(target = receive, daemon = True).start()
+    ready.set()
+    task = asyncio.ensure_future(bot.run_forever(save_interval, poll = False))
+    await stopping.wait()
+    # Finish the updates already taken and send their replies before saving
+    while bot.pending() or bot.outbox.pending() or bot.outbox.busy:
+        await asyncio.sleep(0.05)
+    task.cancel()
+    await asyncio.gather(task, return_exceptions = True)
+    bot.close()
+
+############
+# AUTO RUN #
+############
+# Token and settings are the ones in tgchessbot.py
+shards = os.cpu_count() # Worker processes, fixed once ./shards holds data
+engine_workers = 1 # Engine processes per worker
+
+async def main(front):
+    webhook = None
+    if tgchessbot.webhook_url:
+        secret = tgchessbot.webhook_secret or secrets.token_urlsafe(32)
+        webhook = WebhookServer(front, secret, tgchessbot.webhook_host, tgchessbot.webhook_port)
+        await webhook.start()
+        await front.call(front.set_webhook, tgchessbot.webhook_url, secret)
+    else:
+        await front.call(front.api.deleteWebhook)
+    log.info("Listening...")
+    try:
+        await front.run_forever(webhook = webhook)
+    finally:
+        front.close()
+
+if __name__ == "__main__":
+    logging.basicConfig(level = logging.INFO, format = "%(asctime)s %(levelname)s %(processName)s: %(message)s")
+    front = ShardFront(tgchessbot.telegram_bot_token, int(sys.argv[1]) if len(sys.argv) > 1 else shards, api_url = tgchessbot.api_url,
+                       options = dict(render_workers = tgchessbot.render_workers, render_mode = tgchessbot.render_mode,
+                                      engine_workers = engine_workers, engine_budget = tgchessbot.engine_budget,
+                                      match_ttl = tgchessbot.match_ttl, admins = tgchessbot.admin_ids),
+                       save_interval = tgchessbot.save_interval)
+    asyncio.run(main(front))
@@ -0,0 +1,116 @@
+import os, shutil, tempfile, unittest
+from journal import Journal
+
+class JournalTest(unittest.TestCase):
+    '''Replay must give back every event a snapshot does not cover, however compaction was cut short'''
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.journal = self.open()
+
+    def tearDown(self):
+        self.journal.file.close()
+        shutil.rmtree(self.directory)
+
+    def open(self):
+        '''A journal as a restarted process would load it'''
+        journal = Journal(self.directory)
+        self.loaded = journal.load()
+        return journal
+
+    def restart(self):
+        self.journal.file.close()
+        self.journal = self.open()
+        return self.loaded
+
+    def append(self, *ks):
+        for k in ks:
+            self.journal.append({"k": k})
+
+    def test_replay(self):
+        self.append(1, 2, 3)
+        self.journal.flush()
+        snapshot, events = self.restart()
+        self.assertIsNone(snapshot)
+        self.assertEqual([e["k"] for e in events], [1, 2, 3])
+        self.assertEqual([e["seq"] for e in events], [1, 2, 3])
+        self.assertEqual(self.journal.seq, 3)
+
+    def test_unflushed_events_are_lost(self):
+        self.append(1)
+        self.journal.flush()
+        self.append(2)
+        snapshot, events = self.restart()
+        self.assertEqual([e["k"] for e in events], [1])
+
+    def test_snapshot(self):
+        self.append(1, 2)
+        self.journal.snapshot({"n": 2})
+        self.append(3)
+        self.journal.flush()
+        snapshot, events = self.restart()
+        self.assertEqual(snapshot, {"n": 2})
+        self.assertEqual([e["k"] for e in events], [3])
+        self.assertEqual(sorted(os.listdir(self.directory)), ["journal.ndjson", "snapshot.json"])
+
+    def test_rotate_without_snapshot(self):
+        self.append(1)
+        self.journal.snapshot({"n": 1})
+        self.append(2, 3)
+        self.journal.rotate() # The snapshot after it never got written
+        self.append(4)
+        self.journal.flush()
+        snapshot, events = self.restart()
+        self.assertEqual(snapshot, {"n": 1})
+        self.assertEqual([e["k"] for e in events], [2, 3, 4])
+
+    def test_failed_snapshots_keep_every_event(self):
+        self.append(1)
+        self.journal.rotate()
+        self.append(2)
+        self.journal.rotate()
+        self.append(3)
+        self.journal.flush()
+        snapshot, events = self.restart()
+        self.assertIsNone(snapshot)
+        self.assertEqual([e["k"] for e in events], [1, 2, 3])
+
+        # The next snapshot that makes it covers them all
+        self.journal.snapshot({"n": 3})
+        self.append(4)
+        self.journal.flush()
+        snapshot, events = self.restart()
+        self.assertEqual(snapshot, {"n": 3})
+        self.assertEqual([e["k"] for e in events], [4])
+        self.assertEqual([e["seq"] for e in events], [4])
+
+    def test_events_during_snapshot(self):
+        '''Events appended while a snapshot is being written land in the new journal'''
+        self.append(1, 2)
+        seq, lines = self.journal.begin_rotation()
+        self.append(3)
+        self.journal.switch(lines)
+        self.journal.flush()
+        snapshot, events = self.restart()
+        self.assertEqual([e["k"] for e in events], [1, 2, 3])
+
+        self.journal.write_snapshot(seq, {"n": 2})
+        snapshot, events = self.restart()
+        self.assertEqual(snapshot, {"n": 2})
+        self.assertEqual([e["k"] for e in events], [3])
+
+    def test_torn_write(self):
+        self.append(1, 2)
+        self.journal.flush()
+        with open(self.journal.journal_path, "a") as f:
+            f.write('{"k":3,"se')
+        snapshot, events = self.restart()
+        self.assertEqual([e["k"] for e in events], [1, 2])
+        # New events are not glued onto the torn line
+        self.append(4)
+        self.journal.flush()
+        snapshot, events = self.restart()
+        self.assertEqual([e["k"] for e in events], [1, 2, 4])
+        self.assertEqual([e["seq"] for e in events], [1, 2, 3])
+
+if __name__ == "__main__":
+    unittest.main()
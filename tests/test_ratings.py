@@ -0,0 +1,51 @@
+import random, unittest
+from ratings import RatingIndex, elo
+
+class RatingIndexTest(unittest.TestCase):
+    '''Ranks and leaderboards from the Fenwick tree must agree with sorting every rating'''
+    def check(self, index, ratings):
+        buckets = dict((pid, index.bucket(rating)) for pid, rating in ratings.items())
+        for pid in ratings:
+            self.assertEqual(index.rank(pid), 1 + sum(1 for other in buckets.values() if other > buckets[pid]))
+        ordered = sorted(ratings.values(), reverse = True)
+        for n in (0, 1, 5, len(ratings), len(ratings) + 3):
+            top = index.top(n)
+            self.assertEqual([rating for pid, rating in top], ordered[:n])
+            self.assertTrue(all(ratings[pid] == rating for pid, rating in top))
+            self.assertEqual(len(set(pid for pid, rating in top)), len(top))
+
+    def test_against_sorting(self):
+        rng = random.Random(1)
+        index, ratings = RatingIndex(), {}
+        for step in range(2000):
+            pid = rng.randrange(300)
+            # Some out of range, some landing in the same whole-point bucket
+            rating = rng.choice((rng.uniform(-100, 4100), rng.uniform(1199.5, 1201.5), 1200))
+            index.set(pid, rating)
+            ratings[pid] = rating
+            if step % 100 == 0:
+                self.check(index, ratings)
+        self.assertEqual(len(index), len(ratings))
+        self.check(index, ratings)
+
+    def test_restore(self):
+        rng = random.Random(2)
+        index = RatingIndex()
+        for pid in range(50):
+            index.set(pid, rng.uniform(800, 2000))
+        copy = RatingIndex()
+        copy.restore(index.dump())
+        self.check(copy, dict(index.dump()))
+
+    def test_record_game(self):
+        index = RatingIndex()
+        index.record_game(1, 2, 1)
+        self.assertEqual((index.get(1), index.get(2)), elo(1200, 1200, 1, 32))
+        self.assertEqual((index.rank(1), index.rank(2)), (1, 2))
+        self.assertEqual(index.get(3), 1200)
+        self.assertNotIn(3, index)
+        index.record_game(1, 2, 0.5)
+        self.assertAlmostEqual(index.get(1) + index.get(2), 2400)
+
+if __name__ == "__main__":
+    unittest.main()
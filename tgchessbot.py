@@ -1,17 +1,98 @@
-import time, pickle, os.path
+import asyncio, functools, io, json, logging, pickle, random, re, secrets, time, os.path
+from concurrent.futures import ThreadPoolExecutor
 import telepot  # https://github.com/nickoala/telepot
 from match import *
+from renderpool import *
+from chatqueue import *
+from journal import *
+from msgstore import *
+from matchstore import *
+from ratings import *
+from players import *
+from archive import *
+from engine import *
+from timers import *
+from seekpool import *
+from outbox import *
+from metrics import *
+from botapi import *
+from webhook import *
+
+log = logging.getLogger("tgchessbot")
+
+# Anything python-chess could read as SAN or UCI, possibly with a check marker. Used to skip ordinary chatter cheaply
+MOVE_PATTERN = re.compile(r'^([NBRQK]?[a-h]?[1-8]?[x-]?[a-h][1-8](=?[NBRQnbrq])?|[O0]-[O0](-[O0])?)[+#]?$')
+# Time controls as <minutes>+<increment seconds>, e.g. 5+3 or 0.5+0
+TIME_CONTROL = re.compile(r'^(\d+(?:\.\d+)?)\+(\d+)$')
+# Commands that act on a relayed match when sent from a player's private chat, see /seek
+# Events that change a SharedPlayerStore, which other processes read right away
+SHARED_EVENTS = ("create", "join", "pair", "end")
+RELAYED_COMMANDS = ("/show", "/move", "/offerdraw", "/rejectdraw", "/claimdraw", "/resign")
+
+def parse_time_control(text):
+    '''[base seconds, increment seconds] for a time control like 5+3, or None if text is not one'''
+    m = TIME_CONTROL.match(text)
+    if not m or not 0 < float(m.group(1)) <= 180:
+        return None
+    return [float(m.group(1)) * 60, int(m.group(2))]
+
+def has_opponent(players):
+    '''Whether both sides of a match, as from Match.get_players(), have a player'''
+    return players[0] is not None and players[2] is not None
 
 class tgchessBot(telepot.Bot):
-    def __init__(self, *args, **kwargs):
-        '''Set up local variables'''
+    def __init__(self, *args, board_cache_size=1024, render_workers=2, render_mode='thread', render_queue=64, api_workers=10, engine_workers=2, engine_budget=2.0, remind_after=24*60*60, abandon_after=7*24*60*60, snapshot_every=1000, compact_interval=600, match_ttl=60*60, username='tgchessbot', admins=(), log_sample=100, api=None, data_dir='.', players=None, matchmaking=True, archive_peers=(), **kwargs):
+        '''Set up local variables. api is the Bot API client to send through, this bot itself unless given, see botapi.py.
+        players is where cross-chat player data lives, an in-memory PlayerStore unless given, and archive_peers are
+        the archive directories of other processes whose games /history also lists, see shards.py'''
         super(tgchessBot, self).__init__(*args, **kwargs)
-        self._answerer = telepot.helper.Answerer(self)
-        self.gamelog = {}
-        self.msglog = []
-        self.statslog = {} # Store player stats [W, D, L]
+        self.api = api if api is not None else self
+        self.data_dir = data_dir # Journal, snapshots, matches, messages and archive all live under here
+        self.gamelog = MatchStore(os.path.join(data_dir, 'matches'), ttl = match_ttl) # Idle matches are evicted to ./matches
+        self.msglog = MessageLog(os.path.join(data_dir, 'msglog')) # Every update received, on disk apart from a short tail
+        self.players = players if players is not None else PlayerStore() # Stats, ratings and the active-games index
+        self.archive = GameArchive(os.path.join(data_dir, 'archive'), archive_peers) # Finished games, for /history and /pgn
+        self.journal = Journal(data_dir) # Every change to gamelog and players goes through here, see record()
+        self.disk = ThreadPoolExecutor(1) # Journal and message log writes, in order and off the event loop
+        self.snapshot_every = snapshot_every # Compact the journal after this many events...
+        self.compact_interval = compact_interval # ... or after this many seconds, if anything changed
+        self.next_compaction = time.time() + compact_interval
+        self.board_images = BoardImageCache(board_cache_size) # Encoded boards keyed by (FEN, orientation)
+        self.render_pool = RenderPool(render_workers, render_mode, render_queue)
+        self.api_pool = ThreadPoolExecutor(api_workers) # Blocking Bot API calls run here, off the event loop
+        self.outbox = Outbox(self) # Everything sent to chats is paced, merged and retried here
+        self.engines = EnginePool(engine_workers, engine_budget) # Searches for the built-in opponent, see /create ... vs bot
+        self.engine_retry = 5 # Seconds before a failed engine search is tried again
+        self.chats = ChatSerializer() # Handles each chat's updates in order
+        self.timers = TimerHeap() # Chat id -> its next flag fall or move reminder, see run_timers()
+        self.timer_wakeup = asyncio.Event() # Set when a timer earlier than every other one is scheduled
+        self.seeks = SeekPool() # Players waiting for an opponent through /seek
+        self.relays = {} # Player id -> key of the relayed match played from their private chat
+        self.matchmaking = matchmaking # Whether /seek is available. A player's private chat must be in the same process as the seek pool
+        self.remind_after = remind_after # Seconds an untimed game waits on a player before reminding them...
+        self.abandon_after = abandon_after # ... and before the game is declared abandoned
+
+        self.admins = set(admins) # User ids allowed to use /metrics
+        self.log_sample = log_sample # Log one in every log_sample raw updates at DEBUG level
+        self.updates_seen = 0
+
+        METRICS.track_rate("updates_total")
+        METRICS.gauge("matches_active", lambda: len(self.gamelog))
+        METRICS.gauge("matches_resident", lambda: len(self.gamelog.resident))
+        METRICS.gauge("render_cache_hit_ratio", lambda: self.board_images.hits / max(self.board_images.hits + self.board_images.misses, 1))
+        METRICS.gauge("outbox_pending", lambda: self.outbox.pending())
+        METRICS.gauge("updates_pending", lambda: self.chats.pending())
+        METRICS.gauge("seeks_waiting", lambda: len(self.seeks))
+        METRICS.gauge("timers_pending", lambda: len(self.timers))
 
         self.startsheet, self.helpsheet = self.generate_sheets()
+        self.username = username.lower() # For telling our /cmd@username apart from other bots'
+        # Command registry, every handler takes (chat_id, sender_id, sender_username, args, match)
+        self.commands = {"/start": self.cmd_start, "/help": self.cmd_help, "/create": self.cmd_create, "/join": self.cmd_join,
+                         "/show": self.cmd_show, "/move": self.cmd_move, "/offerdraw": self.cmd_offerdraw, "/rejectdraw": self.cmd_rejectdraw,
+                         "/claimdraw": self.cmd_claimdraw, "/resign": self.cmd_resign, "/stats": self.cmd_stats, "/games": self.cmd_games,
+                         "/top": self.cmd_top, "/history": self.cmd_history, "/pgn": self.cmd_pgn, "/seek": self.cmd_seek,
+                         "/unseek": self.cmd_unseek, "/metrics": self.cmd_metrics}
 
     def generate_sheets(self):
         startsheet = "Hello! This is the Telegram Chess Bot @tgchessbot. \U0001F601\n"
@@ -20,12 +101,15 @@ class tgchessBot(telepot.Bot):
         startsheet += "*About*\n\n"
         startsheet += "You can play chess using @tgchessbot. To play with friends, create a group and invite @tgchessbot into it. If you wish to play alone, talk to @tgchessbot on a 1-on-1 private message.\n\n"
         startsheet += "_How to play_: Someone creates a game and picks a colour (white or black). Someone else (could be the same person) joins and is automatically assigned the other side.\n\n"
+        startsheet += "_Time controls_: Add `<minutes>+<increment>` when creating a game to play with a chess clock, e.g. `/create white 5+3` gives each side 5 minutes plus 3 seconds per move. Running out of time loses the game. In games without a clock, players are reminded when it is their move, and a game left untouched for a week is lost by the player to move.\n\n"
+        startsheet += "_Finding an opponent_: Send `/seek` (or e.g. `/seek 5+3` for a timed game) in a private chat with @tgchessbot to be paired with a player of similar rating. The game is played right there: your moves are relayed to your opponent's private chat and theirs to yours.\n\n"
+        startsheet += "_Playing the bot_: Add `vs bot` when creating a game, e.g. `/create white vs bot`, and @tgchessbot itself takes the other side. Games against the bot are not rated.\n\n"
         startsheet += "_Make your best move_: Make a move by typing `/move <your move>` or just `<your move>`. @tgchessbot is able to recognise both SAN and UCI notations. E.g. `/move e4` or `/move e2e4`, `/move Nf3` or `g1f3`\n\n"
         startsheet += "Every chat conversation is capped to have only 1 match going on at any point in time to avoid confusion (In case multiple people try to play matches simultaneously in the same group chat). For a more enjoyable experience, you may wish to create a group chat with 3 members: You, your friend/opponent and @tgchessbot\n\n"
         startsheet += "*Inline Commands*\n\n"
         startsheet += "You may also make use of inline commands by typing `@tgchessbot <command>`.\n"
-        startsheet += "Currently available commands: `@tgchessbot /start`, `@tgchessbot /help`, `@tgchessbot /stats`.\n\n"
-        startsheet += "`@tgchessbot /stats` displays how many wins, draws and losses you accumulated across all games you have played via @tgchessbot. If user base grows sufficiently large, we intend to incorporate a global ELO rating system.\n\n"
+        startsheet += "Currently available commands: `@tgchessbot /start`, `@tgchessbot /help`, `@tgchessbot /stats`, `@tgchessbot /top`, `@tgchessbot /games`.\n\n"
+        startsheet += "`@tgchessbot /stats` displays how many wins, draws and losses you accumulated across all games you have played via @tgchessbot, along with your Elo rating and global rank. `@tgchessbot /top` shows the leaderboard. Solo games and games against the bot are not rated.\n\n"
         startsheet += "At the moment, we are unable to support inline commands to play your matches unfortunately.\n\n"
         startsheet += "*Contact*\n\n"
         startsheet += "This bot is built with the help of [`telepot`](https://github.com/nickoala/telepot), [`python-chess`](https://github.com/niklasf/python-chess) and [`Pillow`](https://pillow.readthedocs.io/en/3.2.x/), with chess piece images from [Cburnett](https://en.wikipedia.org/wiki/User:Cburnett) on [Wikipedia](https://en.wikipedia.org/wiki/Chess_piece).\n\n"
@@ -34,83 +118,332 @@ class tgchessBot(telepot.Bot):
 
         helpsheet = "Allowed commands:\n"
         helpsheet += "`/help`: Display help sheet\n"
-        helpsheet += "`/create <white/black>`: Creates a chess match with your preferred colour. E.g. `/create white`\n"
+        helpsheet += "`/create <white/black> [minutes+increment] [vs bot]`: Creates a chess match with your preferred colour, optionally with a chess clock. E.g. `/create white`, `/create white 5+3`, or `/create black vs bot` to play against @tgchessbot\n"
         helpsheet += "`/join`: Join the existing match\n"
+        helpsheet += "`/seek [minutes+increment]`: In a private chat with @tgchessbot, find an opponent of similar rating. Moves are relayed between your private chats\n"
+        helpsheet += "`/unseek`: Stop looking for an opponent\n"
         helpsheet += "`/show`: Show current board state\n"
         helpsheet += "`/move <move>` or `<move>`: Make a move using SAN or UCI. E.g. `/move e4` or `/move e2e4`, `/move Nf3` or `g1f3`. To learn more: [https://en.wikipedia.org/wiki/Algebraic_notation_(chess)]\n"
         helpsheet += "`/offerdraw`: Offer a draw. Making a move automatically cancels any existing draw offers.\n"
         helpsheet += "`/rejectdraw`: Reject opponent's draw offer. Making a move automatically rejects any existing draw offers.\n"
         helpsheet += "`/claimdraw`: Accept a draw offer or claim a draw when `fifty-move rule` or `threefold repetition` is met. To learn more: [https://en.wikipedia.org/wiki/Draw_(chess)]\n"
         helpsheet += "`/resign`: Resign from the match\n"
-        helpsheet += "`/stats`: View your game stats across all matches\n\n"
+        helpsheet += "`/stats`: View your game stats, rating and rank across all matches\n"
+        helpsheet += "`/top [N]`: Show the N best rated players (10 by default)\n"
+        helpsheet += "`/games`: List your ongoing matches in all chats and whose turn it is\n"
+        helpsheet += "`/history [page]`: List your finished games, most recent first\n"
+        helpsheet += "`/pgn <number>`: Download a game from `/history` as a PGN file\n\n"
         helpsheet += "If there are multiple bots, append `@tgchessbot` behind your commands. E.g. `/move@tgchessbot e4`"
 
         return startsheet, helpsheet
 
     def save_state(self):
-        '''Saves gamelog, msglog and statslog for persistence'''
-        with open("gamelog.txt", "wb") as f:
-            pickle.dump(self.gamelog, f)
+        '''Flushes journalled changes and new messages to disk, blocking. For when the loop is not running'''
+        self.journal.flush()
+        self.msglog.flush()
+
+    async def flush_state(self):
+        '''Flushes journalled changes and new messages to disk on the disk thread, so chats are not held up by the fsync'''
+        with METRICS.timed("save_state_seconds"):
+            await asyncio.get_running_loop().run_in_executor(self.disk, self.write_state, self.journal.take(), self.msglog.take())
+
+    def write_state(self, events, messages):
+        self.journal.write(events)
+        self.msglog.write(messages)
 
-        with open("msglog.txt", "wb") as f:
-            pickle.dump(self.msglog, f)
+    def compaction_due(self, now):
+        '''Whether the journal has grown long, or old, enough to be compacted into a snapshot'''
+        return self.journal.since_snapshot >= self.snapshot_every or (self.journal.since_snapshot and now >= self.next_compaction)
 
-        with open("statslog.txt", "wb") as f:
-            pickle.dump(self.statslog, f)
+    async def compact(self):
+        '''Snapshot the state and start an empty journal. The state is captured on the loop, then written and
+        fsynced on a worker thread, so chats are not held up while it reaches the disk'''
+        now = time.time()
+        self.next_compaction = now + self.compact_interval
+        with METRICS.timed("compaction_seconds"):
+            loop = asyncio.get_running_loop()
+            # Idle matches leave memory as part of the snapshot, see MatchStore
+            batch = self.gamelog.idle(now)
+            if batch:
+                name, spans = await loop.run_in_executor(None, self.gamelog.write_batch, self.journal.seq, batch)
+                self.gamelog.evict(batch, name, spans)
+            state, live = self.dump_state(), self.gamelog.live_files()
+            seq, events = self.journal.begin_rotation()
+            await loop.run_in_executor(self.disk, self.journal.switch, events)
+            await loop.run_in_executor(None, self.journal.write_snapshot, seq, state)
+            await loop.run_in_executor(None, self.gamelog.collect_garbage, live)
+
+    def dump_state(self):
+        '''Plain representation of gamelog and players for snapshots
+        It is written out on another thread, so it must share no mutable objects with the live state'''
+        state = {"gamelog": self.gamelog.dump(),
+                 "timers": self.timers.dump(),
+                 "seeks": self.seeks.dump(),
+                 "relays": [[pid, key] for pid, key in self.relays.items()]}
+        state.update(self.players.dump())
+        return state
 
     def load_state(self):
-        '''Loads gamelog, msglog and statslog for persistence'''
-        try:
-            with open("gamelog.txt", "rb") as f:
-                self.gamelog = pickle.load(f)
-        except EOFError:
-            self.gamelog = {}
+        '''Loads the latest snapshot and replays the journal on top of it'''
+        snapshot, events = self.journal.load()
+        if snapshot is not None:
+            self.gamelog.restore(snapshot["gamelog"])
+            indexed = self.players.restore(snapshot)
+            self.seeks.restore(snapshot.get("seeks", []))
+            self.relays = dict((pid, key) for pid, key in snapshot.get("relays", []))
+            if "timers" in snapshot:
+                self.timers.restore(snapshot["timers"])
+            else:
+                for match in self.gamelog.values():
+                    self.schedule_timer(match)
+            if not indexed:
+                # Snapshot predates the index, rebuild it once
+                for match in self.gamelog.values():
+                    self.index_game(match.white_id, match.chat_id)
+                    self.index_game(match.black_id, match.chat_id)
+        elif os.path.exists(os.path.join(self.data_dir, "gamelog.txt")):
+            # One-off migration from the pickled state of older versions
+            with open(os.path.join(self.data_dir, "gamelog.txt"), "rb") as f:
+                for chat_id, match in pickle.load(f).items():
+                    self.gamelog[chat_id] = match
+                    self.index_game(match.white_id, chat_id)
+                    self.index_game(match.black_id, chat_id)
+            with open(os.path.join(self.data_dir, "statslog.txt"), "rb") as f:
+                self.players.restore({"statslog": list(pickle.load(f).items())})
+            self.journal.snapshot(self.dump_state())
+        for event in events:
+            self.apply(event)
+        for match in self.gamelog.resident.values():
+            if match.get_turn_id() == ENGINE_ID:
+                # The engine was thinking when we went down, have it move again once running
+                self.set_timer(match.chat_id, time.time(), "engine")
 
-        try:
-            with open("msglog.txt", "rb") as f:
-                self.msglog = pickle.load(f)
-        except EOFError:
-            self.msglog = []
+        legacy_msglog = os.path.join(self.data_dir, "msglog.txt")
+        if os.path.exists(legacy_msglog):
+            # One-off migration of the pickled message log of older versions
+            with open(legacy_msglog, "rb") as f:
+                while 1:
+                    try:
+                        msg = pickle.load(f)
+                    except (EOFError, pickle.UnpicklingError):
+                        break
+                    for m in (msg if isinstance(msg, list) else [msg]):
+                        self.msglog.append(m)
+                    self.msglog.flush()
+            os.rename(legacy_msglog, legacy_msglog + ".migrated")
 
-        try:
-            with open("statslog.txt", "rb") as f:
-                self.statslog = pickle.load(f)
-        except EOFError:
-            self.statslog = {}
+    def record(self, kind, **event):
+        '''Journal a state change, then apply it'''
+        event["type"] = kind
+        self.journal.append(event)
+        if self.players.shared and kind in SHARED_EVENTS:
+            # The shared store changes for good right away, so the event must be on disk first. Otherwise a restart
+            # that lost it would replay the match against a store that has already moved on, see shards.py
+            self.disk.submit(self.journal.write, self.journal.take()).result()
+        return self.apply(event)
+
+    def apply(self, event):
+        '''Apply a journalled event to gamelog and players. Runs live and on replay, so it must not send anything'''
+        return getattr(self, "apply_" + event["type"])(event)
+
+    def apply_create(self, event):
+        match = self.gamelog[event["chat"]] = Match(event["chat"])
+        if event.get("control"):
+            match.set_clock(*event["control"])
+        if event["color"] == "white":
+            match.joinw(event["pid"], event["pname"])
+        else:
+            match.joinb(event["pid"], event["pname"])
+        match.started = event.get("time", match.started)
+        self.index_game(event["pid"], event["chat"])
+        self.publish(match)
+        return match
+
+    def apply_join(self, event):
+        match = self.gamelog[event["chat"]]
+        match.join(event["pid"], event["pname"])
+        # White's clock starts once both players are in
+        match.turn_started = event.get("time")
+        self.index_game(event["pid"], event["chat"])
+        self.schedule_timer(match)
+        self.publish(match)
+
+    def apply_move(self, event):
+        match = self.gamelog[event["chat"]]
+        res = match.make_move(chess.Move.from_uci(event["move"]), event.get("time"))
+        self.schedule_timer(match)
+        self.publish(match)
+        return res
+
+    def apply_offerdraw(self, event):
+        self.gamelog[event["chat"]].offer_draw(event["pid"])
+
+    def apply_rejectdraw(self, event):
+        self.gamelog[event["chat"]].reject_draw()
+
+    def apply_seek(self, event):
+        self.seeks.add({"pid": event["pid"], "name": event["pname"], "rating": event["rating"], "control": event["control"], "time": event["time"]})
+        if "seeks" not in self.timers:
+            self.set_timer("seeks", event["time"] + self.seeks.sweep_every, "sweep")
+
+    def apply_unseek(self, event):
+        self.seeks.remove(event["pid"])
+
+    def apply_pair(self, event):
+        '''Two seeks answered each other: their relayed match starts at once'''
+        match = self.gamelog[event["chat"]] = Match(event["chat"])
+        match.joinw(*event["white"])
+        match.joinb(*event["black"])
+        if event["control"]:
+            match.set_clock(*event["control"])
+        match.started = match.turn_started = event["time"]
+        for pid, pname in (event["white"], event["black"]):
+            self.seeks.remove(pid)
+            self.relays[pid] = event["chat"]
+            self.index_game(pid, event["chat"])
+        self.schedule_timer(match)
+        self.publish(match)
+        return match
+
+    def apply_end(self, event):
+        # Remove match from game logs
+        match = self.gamelog.pop(event["chat"])
+        players = match.get_players()
+        self.timers.cancel(event["chat"])
+        self.unindex_game(players[0], event["chat"])
+        self.unindex_game(players[2], event["chat"])
+        if self.players.shared:
+            self.players.clear_status(event["chat"])
+        for pid in (players[0], players[2]):
+            if self.relays.get(pid) == event["chat"]:
+                del self.relays[pid]
+
+        # A match ended before anyone joined is not a game, so it counts for nothing
+        if not has_opponent(players):
+            return
+        # Solo games and games against the engine are not rated
+        rated = players[0] != players[2] and ENGINE_ID not in (players[0], players[2]) and event["winner"] in ("White", "Black", "Draw")
+        # The chat and start time name the game, so a shared store can tell a replayed end from a new one
+        self.players.record_result(json.dumps([event["chat"], match.started]), players[:2], players[2:], event["winner"], rated)
+
+    def schedule_timer(self, match):
+        '''Point the chat's timer at the match's next deadline: flag fall in timed games, a reminder in untimed ones'''
+        deadline = match.deadline()
+        if deadline is not None:
+            self.set_timer(match.chat_id, deadline, "flag")
+        elif match.turn_started is not None and match.get_turn_id() != ENGINE_ID and self.remind_after:
+            self.set_timer(match.chat_id, match.turn_started + self.remind_after, "remind")
+        else:
+            self.timers.cancel(match.chat_id)
+
+    def set_timer(self, chat_id, when, kind):
+        earliest = self.timers.next_deadline()
+        self.timers.schedule(chat_id, when, kind)
+        if earliest is None or when < earliest:
+            self.timer_wakeup.set()
+
+    async def run_timers(self):
+        '''Fire due timers forever. This one task and one heap serve the deadlines of every game'''
+        while 1:
+            self.timer_wakeup.clear()
+            deadline = self.timers.next_deadline()
+            try:
+                await asyncio.wait_for(self.timer_wakeup.wait(), None if deadline is None else max(deadline - time.time(), 0))
+            except asyncio.TimeoutError:
+                pass
+            for chat_id, kind in self.timers.pop_due(time.time()):
+                # Queued behind the chat's updates, so a move arriving at the last moment is handled first
+                self.chats.submit(chat_id, self.on_timer, chat_id)
+
+    async def on_timer(self, chat_id):
+        '''A chat's timer went off. The match decides what, if anything, is actually due'''
+        if chat_id == "seeks":
+            await self.sweep_seeks()
+            return
+        match = self.gamelog.get(chat_id)
+        if match == None:
+            return
+        now = time.time()
+        turn_id = match.get_turn_id()
+        if turn_id == ENGINE_ID and (match.deadline() is None or now < match.deadline()):
+            # The engine's reply was lost, see engine_move and load_state. Nothing else can be thinking for this
+            # chat now, as engine replies are awaited by the chat's own handlers
+            await self.engine_move(chat_id, match)
+            return
+        if match.turn_started is None:
+            return
+        if match.deadline() is not None:
+            if now >= match.deadline():
+                await self.flag(chat_id, match)
+            else:
+                self.schedule_timer(match)
+            return
+        idle = now - match.turn_started
+        if self.abandon_after and idle >= self.abandon_after:
+            await self.reply(chat_id, "{} ({}) has not moved for {} days, the game is abandoned.".format(match.get_name(turn_id), match.get_color(turn_id), int(idle // 86400)), NOTICE)
+            await self.game_end(chat_id, match.get_players(), match.get_opp_color(turn_id), "abandonment")
+        elif self.remind_after and idle >= self.remind_after and turn_id != ENGINE_ID:
+            await self.reply(chat_id, "@{} ({}), it's your move. Use /show to see the board.".format(match.get_name(turn_id), match.get_color(turn_id)), NOTICE)
+            # Remind again every remind_after, then give up on the game
+            when = match.turn_started + (idle // self.remind_after + 1) * self.remind_after
+            if self.abandon_after:
+                when = min(when, match.turn_started + self.abandon_after)
+            self.set_timer(chat_id, when, "remind")
+        else:
+            self.schedule_timer(match)
+
+    async def flag(self, chat_id, match):
+        '''The side to move ran out of time. They lose, unless their opponent could never mate'''
+        turn_id = match.get_turn_id()
+        await self.reply(chat_id, "{} ({}) ran out of time.".format(match.get_name(turn_id), match.get_color(turn_id)))
+        if match.board.has_insufficient_material(not match.board.turn):
+            await self.game_end(chat_id, match.get_players(), "Draw", "time forfeit")
+        else:
+            await self.game_end(chat_id, match.get_players(), match.get_opp_color(turn_id), "time forfeit")
+
+    def index_game(self, pid, chat_id):
+        '''Note that pid plays in chat_id's match'''
+        if pid != None and pid != ENGINE_ID:
+            self.players.index_game(pid, chat_id)
+
+    def unindex_game(self, pid, chat_id):
+        if pid != None and pid != ENGINE_ID:
+            self.players.unindex_game(pid, chat_id)
+
+    def publish(self, match):
+        '''Let /games in other processes describe the match, when players are shared with them'''
+        if self.players.shared:
+            self.players.set_status(match.chat_id, match.status())
 
     def is_in_game(self, players, sender_id):
         '''Checks if message sender is involved in the match'''
         return sender_id == players[0] or sender_id == players[2]
 
-    def game_end(self, chat_id, players, winner):
-        '''Handle end of game situation'''
-        # Remove match from game logs
-        del self.gamelog[chat_id]
+    def finish(self, chat_id, players, winner, reason):
+        '''Record the end of the game, archive it and return the outcome to announce'''
+        match = self.gamelog[chat_id]
+        self.record("end", chat = chat_id, winner = winner, reason = reason)
+        if has_opponent(players):
+            self.archive.add(match, winner, reason)
+        if ENGINE_ID in (players[0], players[2]):
+            self.engines.forget(chat_id)
 
-        # Update player stats [W, D, L] and print results
-        if players[0] not in self.statslog: self.statslog[players[0]] = [0,0,0]
-        if players[2] not in self.statslog: self.statslog[players[2]] = [0,0,0]
-        white_stats = self.statslog[players[0]]
-        black_stats = self.statslog[players[2]]
-
-        # Format and send game outcome
+        # Format game outcome
         outcome = ""
-        if winner == "White":
-            white_stats[0] += 1
-            black_stats[2] += 1
+        if not has_opponent(players):
+            # Nobody joined, so there is no result to announce, see apply_end
+            outcome = "Chess match cancelled, nobody joined."
+        elif winner == "White":
             outcome = "White wins! {} (W) versus {} (B) : 1-0".format(players[1], players[3])
         elif winner == "Black":
-            white_stats[2] += 1
-            black_stats[0] += 1
             outcome = "Black wins! {} (W) versus {} (B) : 0-1".format(players[1], players[3])
         elif winner == "Draw":
-            white_stats[1] += 1
-            black_stats[1] += 1
             outcome = "It's a draw! {} (W) versus {} (B) : 0.5-0.5".format(players[1], players[3])
-        self.statslog[players[0]] = white_stats
-        self.statslog[players[2]] = black_stats
+        return outcome
 
-        bot.sendMessage(chat_id, outcome)
+    async def game_end(self, chat_id, players, winner, reason):
+        '''Handle end of game situation'''
+        await self.reply(chat_id, self.finish(chat_id, players, winner, reason))
 
     def get_sender_details(self, msg):
         '''Extract sender id and name to be used in the match'''
@@ -125,196 +458,578 @@ class tgchessBot(telepot.Bot):
             sender_username = "Nameless"
         return sender_id, sender_username
 
+    async def call(self, method, *args, **kwargs):
+        '''Run a blocking Bot API method on the API thread pool and wait for its result'''
+        with METRICS.timed("telegram_api_seconds", method = method.__name__):
+            return await asyncio.get_running_loop().run_in_executor(self.api_pool, functools.partial(method, *args, **kwargs))
+
+    def destinations(self, chat_id):
+        '''Chats that see a match's messages. The key of a relayed match names both players' private chats'''
+        if isinstance(chat_id, str) and chat_id.startswith("relay:"):
+            return [int(pid) for pid in chat_id.split(":")[2:]]
+        return [chat_id]
+
+    async def reply(self, chat_id, text, priority=REPLY, **kwargs):
+        '''Queue a text message to the chat. Returns once it is queued, with a future for Telegram's answer'''
+        sent = None
+        for dest in self.destinations(chat_id):
+            sent = self.outbox.send_text(dest, text, priority, **kwargs)
+        return sent
+
+    async def upload_board(self, chat_id, image, caption):
+        '''Queue an encoded board. The outbox reuses Telegram's file_id once this image has been uploaded'''
+        sent = None
+        for dest in self.destinations(chat_id):
+            sent = self.outbox.send_photo(dest, image, caption)
+        return sent
+
+    async def send_board(self, chat_id, match, caption):
+        '''Send the current position, rendering it on the pool only on a cache miss'''
+        key = match.board_key()
+        image = self.board_images.get(key)
+        if image is None:
+            try:
+                # Waits for a while when the pool is saturated, slowing this chat instead of piling up work
+                data = await self.render_pool.render(key[0], key[1], match.frames, timeout = 5)
+            except RenderPoolFull:
+                await self.reply(chat_id, "Too busy to draw the board right now, use /show to see it.")
+                return
+            image = self.board_images.put(key, data)
+        return await self.upload_board(chat_id, image, caption)
+
     def get_games_involved(self, sender_id):
-        return [g for g in self.gamelog.values() if self.is_in_game(g.get_players(), sender_id)]
+        '''Status of each ongoing match of a player, found through the active-games index
+        Matches kept by other processes, see shards.py, are described by the status they published.'''
+        games = []
+        for chat_id in self.players.games(sender_id):
+            match = self.gamelog.peek(chat_id)
+            status = match.status() if match != None else self.players.status(chat_id)
+            if status != None:
+                games.append(status)
+        return games
+
+    def games_summary(self, sender_id, sender_username):
+        '''One line per ongoing match of the player, saying whose turn it is'''
+        games = self.get_games_involved(sender_id)
+        if not games:
+            return "{} has no ongoing games.".format(sender_username)
+        lines = ["{}'s ongoing games:".format(sender_username)]
+        for game in games:
+            if game["turn"] == None:
+                status = "waiting for an opponent"
+            else:
+                turn_id, turn_name, turn_color = game["turn"]
+                status = "{} ({}) to move".format("you" if turn_id == sender_id else turn_name, turn_color)
+            lines.append("{} (W) versus {} (B), move {}: {}.".format(game["white"][1] or "?", game["black"][1] or "?", game["move"], status))
+        return "\n".join(lines)
 
-    def on_chat_message(self, msg):
+    def log_update(self, kind, msg):
+        '''Count an update, and log a sample of them. Logging every one costs too much under load'''
         self.msglog.append(msg)
+        METRICS.inc("updates_total", type = kind)
+        self.updates_seen += 1
+        if self.updates_seen % self.log_sample == 0 and log.isEnabledFor(logging.DEBUG):
+            log.debug("%s (1 in %d): %s", kind, self.log_sample, msg)
+
+    async def on_chat_message(self, msg):
+        self.log_update("message", msg)
         content_type, chat_type, chat_id = telepot.glance(msg)
+        if content_type != "text":
+            # Stickers, photos, joins and the like can never be commands or moves
+            return
         sender_id, sender_username = self.get_sender_details(msg)
-        print(msg, sender_id, sender_username)
 
         # Note:
         # if chat_id == sender_id, then it's a human-to-bot 1-on-1 chat
         # if chat_id != sender_id, then chat_id is group chat id
-        print('Chat Message:', content_type, chat_type, chat_id, msg[content_type])
-
-        tokens = msg[content_type].split(" ")
-        match = self.gamelog[chat_id] if chat_id in self.gamelog.keys() else None
-        players = match.get_players() if match != None else None
-
-        if tokens[0] == "/start" or tokens[0] == "/start@tgchessbot":
-            bot.sendMessage(chat_id, self.startsheet, parse_mode = "Markdown", disable_web_page_preview = True)
-        elif tokens[0] == "/help" or tokens[0] == "/help@tgchessbot":
-            bot.sendMessage(chat_id, self.helpsheet, parse_mode = "Markdown", disable_web_page_preview = True)
-        elif tokens[0] == "/create" or tokens[0] == "/create@tgchessbot":
-            # !create <current player color: white/black>
-            if len(tokens) < 2:
-                bot.sendMessage(chat_id, "Incorrect usage. `Usage: /create <White/Black>`. E.g. `/create white`", parse_mode='Markdown')
-            tokens[1] = tokens[1].lower()
-            if tokens[1] != "white" and tokens[1] != "black":
-                bot.sendMessage(chat_id, "Incorrect usage. `Usage: /create <White/Black>`. E.g. `/create white`", parse_mode='Markdown')
-            elif match != None:
-                bot.sendMessage(chat_id, "There is already a chess match going on.")
-            else:
-                self.gamelog[chat_id] = Match(chat_id)
-                match = self.gamelog[chat_id]
-                if tokens[1] == "white":
-                    match.joinw(sender_id, sender_username)
-                else:
-                    match.joinb(sender_id, sender_username)
-                bot.sendMessage(chat_id, "Chess match created. {} is playing as {}. Waiting for opponent...".format(sender_username, tokens[1]), parse_mode = "Markdown")
-        elif tokens[0] == "/join" or tokens[0] == "/join@tgchessbot":
-            if match == None:
-                bot.sendMessage(chat_id, "There is no chess match going on.")
-            elif match.white_id != None and match.black_id != None:
-                bot.sendMessage(chat_id, "Game is already full.")
-            else:
-                match.join(sender_id, sender_username)
-                players = match.get_players()
-                bot.sendMessage(chat_id, "Chess match joined.\n{} (W) versus {} (B)".format(players[1], players[3]), parse_mode = "Markdown")
-
-                # Print starting game state
-                filename = match.print_board(chat_id)
-                turn_id = match.get_turn_id()
-                bot.sendPhoto(chat_id, open(filename, "rb"), caption = "@{} ({}) to move.".format(match.get_name(turn_id), match.get_color(turn_id)))
-        elif tokens[0] == "/show" or tokens[0] == "/show@tgchessbot":
-            if match == None:
-                bot.sendMessage(chat_id, "There is no chess match going on.")
-            elif match.white_id == None or match.black_id == None:
-                bot.sendMessage(chat_id, "Game still lacks another player.")
-            else:
-                filename = match.print_board(chat_id)
-                turn_id = match.get_turn_id()
-                bot.sendPhoto(chat_id, open(filename, "rb"), caption = "{} ({}) to move.".format(match.get_name(turn_id), match.get_color(turn_id)))
-        elif tokens[0] == "/move" or tokens[0] == "/move@tgchessbot" or (match and match.parse_move(tokens[0])): # !move <SAN move>
-            if match == None:
-                bot.sendMessage(chat_id, "There is no chess match going on.")
-            elif not self.is_in_game(players, sender_id):
-                bot.sendMessage(chat_id, "You are not involved in the chess match.")
-            elif match.get_turn_id() != sender_id:
-                bot.sendMessage(chat_id, "It's not your turn.")
-            else:
-                had_offer = False
-                if match.drawoffer != None:
-                    had_offer = True
-                move = tokens[0] if match.parse_move(tokens[0]) else ''.join(tokens[1:])
-                res = match.make_move(move)
-                if res == "Invalid":
-                    bot.sendMessage(chat_id, "`{}` is not a valid move.".format(move), parse_mode = "Markdown")
-                else:
-                    if had_offer:
-                        bot.sendMessage(chat_id, 'Draw offer cancelled.')
-                    filename = match.print_board(chat_id)
-                    if res == "Checkmate":
-                        bot.sendPhoto(chat_id, open(filename, "rb"), caption = "Checkmate!")
-                        self.game_end(chat_id, players, match.get_color(sender_id))
-                    elif res == "Stalemate":
-                        bot.sendPhoto(chat_id, open(filename, "rb"), caption = "Stalemate!")
-                        self.game_end(chat_id, players, "Draw")
-                    elif res == "Check":
-                        bot.sendPhoto(chat_id, open(filename, "rb"), caption = "Check!")
-                    else:
-                        turn_id = match.get_turn_id()
-                        bot.sendPhoto(chat_id, open(filename, "rb"), caption = "@{} ({}) to move.".format(match.get_name(turn_id), match.get_color(turn_id)))
-        elif tokens[0] == "/offerdraw" or tokens[0] == "/offerdraw@tgchessbot": # Offer a draw
-            if match == None:
-                bot.sendMessage(chat_id, "There is no chess match going on.")
-            elif not self.is_in_game(players, sender_id):
-                bot.sendMessage(chat_id, "You are not involved in the chess match.")
-            elif match.get_turn_id() != sender_id:
-                bot.sendMessage(chat_id, "It's not your turn.")
-            else:
-                match.offer_draw(sender_id)
-                bot.sendMessage(chat_id, "{} ({}) offers a draw.".format(sender_username, match.get_color(sender_id)))
-        elif tokens[0] == "/rejectdraw" or tokens[0] == "/rejectdraw@tgchessbot": # Reject draw offer
-            if match == None:
-                bot.sendMessage(chat_id, "There is no chess match going on.")
-            elif not self.is_in_game(players, sender_id):
-                bot.sendMessage(chat_id, "You are not involved in the chess match.")
-            elif match.drawoffer == match.get_opp_id(sender_id):
-                match.reject_draw()
-                bot.sendMessage(chat_id, 'Draw offer cancelled by {} ({}).'.format(sender_username, match.get_color(sender_id)))
-            else:
-                bot.sendMessage(chat_id, "There is no draw offer to reject.")
-        elif tokens[0] == "/claimdraw" or tokens[0] == "/claimdraw@tgchessbot": # Either due to offer or repeated moves
-            if match == None:
-                bot.sendMessage(chat_id, "There is no chess matches going on.")
-            elif not self.is_in_game(players, sender_id):
-                bot.sendMessage(chat_id, "You are not involved in the chess match.")
-            elif match.get_turn_id() != sender_id:
-                bot.sendMessage(chat_id, "It's not your turn.")
-            elif match.board.can_claim_draw() or match.drawoffer == match.get_opp_id(sender_id):
-                self.game_end(chat_id, players, "Draw")
-            else:
-                bot.sendMessage(chat_id, "Current match situation does not warrant a draw.")
-        elif tokens[0] == "/resign" or tokens[0] == "/resign@tgchessbot":
-            if match == None:
-                bot.sendMessage(chat_id, "There is no chess match going on.")
-            elif not self.is_in_game(players, sender_id):
-                bot.sendMessage(chat_id, "You are not involved in the chess match.")
-            else:
-                bot.sendMessage(chat_id, "`{} ({}) resigns!`".format(sender_username, match.get_color(sender_id)), parse_mode='Markdown')
-                self.game_end(chat_id, players, match.get_opp_color(sender_id))
-        elif tokens[0] == "/stats" or tokens[0] == "/stats@tgchessbot":
-            if sender_id not in self.statslog:
-                bot.sendMessage(chat_id, "You have not completed any games with @tgchessbot.")
+
+        tokens = msg[content_type].split()
+        if not tokens:
+            return
+        if tokens[0].startswith("/"):
+            # /cmd and /cmd@tgchessbot both map to /cmd; commands addressed to other bots are ignored
+            command, _, target = tokens[0].partition("@")
+            command = command.lower()
+            if command not in self.commands or (target and target.lower() != self.username):
+                return
+            args = tokens[1:]
+        elif MOVE_PATTERN.match(tokens[0]):
+            # Only text shaped like a move reaches python-chess
+            command, args = None, tokens[:1]
+        else:
+            return
+
+        relay = self.relays.get(chat_id) if chat_id not in self.gamelog else None
+        if relay is not None and (command == None or command in RELAYED_COMMANDS):
+            # Both players' private chats act on a relayed match, so it gets a queue of its own
+            self.chats.submit(relay, self.on_relayed, (relay, command, sender_id, sender_username, args))
+        elif command != None:
+            with METRICS.timed("command_seconds", command = command):
+                await self.commands[command](chat_id, sender_id, sender_username, args, self.gamelog.get(relay or chat_id))
+        else:
+            match = self.gamelog.get(chat_id)
+            move = match.parse_move(tokens[0]) if match != None else None
+            if move:
+                with METRICS.timed("command_seconds", command = "move"):
+                    await self.play_move(chat_id, sender_id, match, tokens[0], move)
+
+    async def on_relayed(self, item):
+        '''A command sent to a relayed match from one of its players' private chats'''
+        relay, command, sender_id, sender_username, args = item
+        match = self.gamelog.get(relay)
+        if command != None:
+            with METRICS.timed("command_seconds", command = command):
+                await self.commands[command](relay, sender_id, sender_username, args, match)
+        else:
+            # Bare moves that do not parse are ignored, as in any other chat
+            move = match.parse_move(args[0]) if match != None else None
+            if move:
+                with METRICS.timed("command_seconds", command = "move"):
+                    await self.play_move(relay, sender_id, match, args[0], move)
+
+    async def cmd_start(self, chat_id, sender_id, sender_username, args, match):
+        await self.reply(chat_id, self.startsheet, parse_mode = "Markdown", disable_web_page_preview = True)
+
+    async def cmd_help(self, chat_id, sender_id, sender_username, args, match):
+        await self.reply(chat_id, self.helpsheet, parse_mode = "Markdown", disable_web_page_preview = True)
+
+    async def cmd_create(self, chat_id, sender_id, sender_username, args, match):
+        # !create <current player color: white/black> [<minutes>+<increment>] [vs bot]
+        color = args[0].lower() if args else None
+        rest = [arg.lower() for arg in args[1:]]
+        control = None
+        if rest and TIME_CONTROL.match(rest[0]):
+            control = parse_time_control(rest[0])
+            rest = rest[1:] if control else rest
+        vs_bot = rest == ["vs", "bot"]
+        if (color != "white" and color != "black") or (rest and not vs_bot):
+            await self.reply(chat_id, "Incorrect usage. `Usage: /create <White/Black> [minutes+increment] [vs bot]`. E.g. `/create white` or `/create white 5+3`", parse_mode='Markdown')
+        elif match != None:
+            await self.reply(chat_id, "There is already a chess match going on.")
+        elif vs_bot:
+            self.leave_pool(chat_id, sender_id)
+            match = self.record("create", chat = chat_id, color = color, pid = sender_id, pname = sender_username, control = control, time = time.time())
+            self.record("join", chat = chat_id, pid = ENGINE_ID, pname = ENGINE_NAME, time = time.time())
+            players = match.get_players()
+            await self.reply(chat_id, "Chess match created.\n{} (W) versus {} (B)".format(players[1], players[3]))
+            await self.next_turn(chat_id, match)
+        else:
+            self.leave_pool(chat_id, sender_id)
+            match = self.record("create", chat = chat_id, color = color, pid = sender_id, pname = sender_username, control = control, time = time.time())
+            await self.reply(chat_id, "Chess match created. {} is playing as {}{}. Waiting for opponent...".format(sender_username, color,
+                             " with {} clock".format(args[1]) if control else ""), parse_mode = "Markdown")
+
+    def leave_pool(self, chat_id, sender_id):
+        '''A game in the sender's private chat would hide a relayed match, so creating one there ends their seek'''
+        if chat_id == sender_id and sender_id in self.seeks:
+            self.record("unseek", pid = sender_id)
+
+    async def cmd_seek(self, chat_id, sender_id, sender_username, args, match):
+        control = parse_time_control(args[0]) if args else None
+        if not self.matchmaking:
+            await self.reply(chat_id, "Finding an opponent is not available on this server. Create a game in a group with /create instead.")
+        elif chat_id != sender_id:
+            await self.reply(chat_id, "Use /seek in a private chat with @tgchessbot.")
+        elif args and control is None:
+            await self.reply(chat_id, "Incorrect usage. `Usage: /seek [minutes+increment]`. E.g. `/seek` or `/seek 5+3`", parse_mode='Markdown')
+        elif match != None:
+            await self.reply(chat_id, "Finish your current chess match first.")
+        else:
+            now = time.time()
+            # Seeking again replaces the earlier seek
+            self.record("seek", pid = sender_id, pname = sender_username, rating = self.players.rating(sender_id), control = control, time = now)
+            if not await self.pair(sender_id, now):
+                await self.reply(chat_id, "Looking for an opponent{}... Use /unseek to stop.".format(" for a {} game".format(args[0]) if control else ""))
+
+    async def cmd_unseek(self, chat_id, sender_id, sender_username, args, match):
+        if sender_id in self.seeks:
+            self.record("unseek", pid = sender_id)
+            await self.reply(chat_id, "Stopped looking for an opponent.")
+        else:
+            await self.reply(chat_id, "You are not looking for an opponent.")
+
+    async def pair(self, pid, now):
+        '''Pair pid's seek with a waiting player, if there is a suitable one, and start their relayed match'''
+        opp = self.seeks.find(pid, now)
+        if opp is None:
+            return False
+        white, black = random.sample([self.seeks.seeks[pid], self.seeks.seeks[opp]], 2)
+        # The key names both private chats, see destinations(). The journal sequence number makes it unique
+        key = "relay:{}:{}:{}".format(self.journal.seq + 1, white["pid"], black["pid"])
+        match = self.record("pair", chat = key, white = [white["pid"], white["name"]], black = [black["pid"], black["name"]],
+                            control = white["control"], time = now)
+        await self.reply(key, "Opponent found! {} (W) versus {} (B). Moves you send here are relayed to your opponent.".format(white["name"], black["name"]))
+        await self.next_turn(key, match)
+        return True
+
+    async def sweep_seeks(self):
+        '''Pair seeks whose accepted rating range has widened since they were made, longest waiting first'''
+        now = time.time()
+        for pid in list(self.seeks.seeks):
+            if pid in self.seeks:
+                await self.pair(pid, now)
+        if len(self.seeks):
+            self.set_timer("seeks", now + self.seeks.sweep_every, "sweep")
+
+    async def cmd_join(self, chat_id, sender_id, sender_username, args, match):
+        if match == None:
+            await self.reply(chat_id, "There is no chess match going on.")
+        elif match.white_id != None and match.black_id != None:
+            await self.reply(chat_id, "Game is already full.")
+        else:
+            self.record("join", chat = chat_id, pid = sender_id, pname = sender_username, time = time.time())
+            players = match.get_players()
+            await self.reply(chat_id, "Chess match joined.\n{} (W) versus {} (B)".format(players[1], players[3]), parse_mode = "Markdown")
+
+            # Print starting game state
+            await self.next_turn(chat_id, match)
+
+    async def cmd_show(self, chat_id, sender_id, sender_username, args, match):
+        if match == None:
+            await self.reply(chat_id, "There is no chess match going on.")
+        elif match.white_id == None or match.black_id == None:
+            await self.reply(chat_id, "Game still lacks another player.")
+        else:
+            turn_id = match.get_turn_id()
+            await self.send_board(chat_id, match, "{} ({}) to move.{}".format(match.get_name(turn_id), match.get_color(turn_id), match.clock_text(time.time())))
+            if turn_id == ENGINE_ID:
+                # The engine's reply was lost, e.g. to a restart while it was thinking
+                await self.engine_move(chat_id, match)
+
+    async def cmd_move(self, chat_id, sender_id, sender_username, args, match): # !move <SAN move>
+        await self.play_move(chat_id, sender_id, match, ''.join(args), None)
+
+    async def play_move(self, chat_id, sender_id, match, text, move):
+        '''Make a move for the sender. move is text already parsed, or None if it still needs parsing'''
+        if match == None:
+            await self.reply(chat_id, "There is no chess match going on.")
+            return
+        players = match.get_players()
+        if not self.is_in_game(players, sender_id):
+            await self.reply(chat_id, "You are not involved in the chess match.")
+        elif match.get_turn_id() != sender_id:
+            await self.reply(chat_id, "It's not your turn.")
+        elif match.deadline() is not None and time.time() >= match.deadline():
+            # The timer has not gone off yet, but the flag has fallen
+            await self.flag(chat_id, match)
+        else:
+            had_offer = False
+            if match.drawoffer != None:
+                had_offer = True
+            move = move or match.parse_move(text)
+            if not move:
+                await self.reply(chat_id, "`{}` is not a valid move.".format(text), parse_mode = "Markdown")
             else:
-                pstats = self.statslog[sender_id]
-                bot.sendMessage(chat_id, "{}: {} wins, {} draws, {} losses.".format(sender_username, pstats[0], pstats[1], pstats[2]))
+                res = self.record("move", chat = chat_id, move = move.uci(), time = time.time())
+                if had_offer:
+                    await self.reply(chat_id, 'Draw offer cancelled.')
+                await self.after_move(chat_id, match, players, sender_id, res)
+
+    async def after_move(self, chat_id, match, players, mover_id, res):
+        '''Announce the position after mover_id's move, ending the game or handing over to the engine as needed'''
+        if res == "Checkmate":
+            # Record the result before the board goes out
+            outcome = self.finish(chat_id, players, match.get_color(mover_id), "checkmate")
+            await self.send_board(chat_id, match, "Checkmate!")
+            await self.reply(chat_id, outcome)
+        elif res == "Stalemate":
+            outcome = self.finish(chat_id, players, "Draw", "stalemate")
+            await self.send_board(chat_id, match, "Stalemate!")
+            await self.reply(chat_id, outcome)
+        elif res == "Check" and match.get_turn_id() != ENGINE_ID:
+            await self.send_board(chat_id, match, "Check!")
+        else:
+            await self.next_turn(chat_id, match)
+
+    async def next_turn(self, chat_id, match):
+        '''Show the board to whoever moves next. When that is the engine, it replies with its move instead'''
+        turn_id = match.get_turn_id()
+        if turn_id == ENGINE_ID:
+            await self.engine_move(chat_id, match)
+        else:
+            await self.send_board(chat_id, match, "@{} ({}) to move.{}".format(match.get_name(turn_id), match.get_color(turn_id), match.clock_text(time.time())))
+
+    async def engine_move(self, chat_id, match):
+        '''Let the engine think on its worker and play its move. The chat's later updates wait, other chats do not'''
+        limit = None
+        if match.clock is not None:
+            # Spread the engine's time over the rest of the game
+            limit = match.remaining(time.time())[0 if match.board.turn else 1] / 30 + match.clock[2] / 2
+        try:
+            move = await self.engines.best_move(chat_id, match.board, limit)
+        except Exception:
+            log.exception("Engine search failed in %s, trying again shortly", chat_id)
+            self.set_timer(chat_id, time.time() + self.engine_retry, "engine")
+            return
+        if move is None or self.gamelog.peek(chat_id) is not match:
+            return
+        if match.deadline() is not None and time.time() >= match.deadline():
+            await self.flag(chat_id, match)
+            return
+        san = match.board.san(move)
+        res = self.record("move", chat = chat_id, move = move.uci(), time = time.time())
+        await self.reply(chat_id, "`{} ({}) plays {}`".format(ENGINE_NAME, match.get_color(ENGINE_ID), san), parse_mode = "Markdown")
+        await self.after_move(chat_id, match, match.get_players(), ENGINE_ID, res)
+
+    async def cmd_offerdraw(self, chat_id, sender_id, sender_username, args, match): # Offer a draw
+        if match == None:
+            await self.reply(chat_id, "There is no chess match going on.")
+        elif not self.is_in_game(match.get_players(), sender_id):
+            await self.reply(chat_id, "You are not involved in the chess match.")
+        elif match.get_turn_id() != sender_id:
+            await self.reply(chat_id, "It's not your turn.")
+        else:
+            self.record("offerdraw", chat = chat_id, pid = sender_id)
+            await self.reply(chat_id, "{} ({}) offers a draw.".format(sender_username, match.get_color(sender_id)))
+
+    async def cmd_rejectdraw(self, chat_id, sender_id, sender_username, args, match): # Reject draw offer
+        if match == None:
+            await self.reply(chat_id, "There is no chess match going on.")
+        elif not self.is_in_game(match.get_players(), sender_id):
+            await self.reply(chat_id, "You are not involved in the chess match.")
+        elif match.drawoffer == match.get_opp_id(sender_id):
+            self.record("rejectdraw", chat = chat_id)
+            await self.reply(chat_id, 'Draw offer cancelled by {} ({}).'.format(sender_username, match.get_color(sender_id)))
+        else:
+            await self.reply(chat_id, "There is no draw offer to reject.")
+
+    async def cmd_claimdraw(self, chat_id, sender_id, sender_username, args, match): # Either due to offer or repeated moves
+        if match == None:
+            await self.reply(chat_id, "There is no chess matches going on.")
+        elif not self.is_in_game(match.get_players(), sender_id):
+            await self.reply(chat_id, "You are not involved in the chess match.")
+        elif match.get_turn_id() != sender_id:
+            await self.reply(chat_id, "It's not your turn.")
+        elif match.drawoffer == match.get_opp_id(sender_id):
+            await self.game_end(chat_id, match.get_players(), "Draw", "draw agreed")
+        elif match.board.can_claim_draw():
+            await self.game_end(chat_id, match.get_players(), "Draw", "draw claimed")
+        else:
+            await self.reply(chat_id, "Current match situation does not warrant a draw.")
+
+    async def cmd_resign(self, chat_id, sender_id, sender_username, args, match):
+        if match == None:
+            await self.reply(chat_id, "There is no chess match going on.")
+        elif not self.is_in_game(match.get_players(), sender_id):
+            await self.reply(chat_id, "You are not involved in the chess match.")
+        else:
+            await self.reply(chat_id, "`{} ({}) resigns!`".format(sender_username, match.get_color(sender_id)), parse_mode='Markdown')
+            await self.game_end(chat_id, match.get_players(), match.get_opp_color(sender_id), "resignation")
+
+    def stats_summary(self, sender_id, sender_username):
+        '''W/D/L record of the player, with rating and global rank once rated'''
+        pstats = self.players.stats(sender_id)
+        if pstats == None:
+            return "You have not completed any games with @tgchessbot."
+        summary = "{}: {} wins, {} draws, {} losses.".format(sender_username, pstats[0], pstats[1], pstats[2])
+        rank = self.players.rank(sender_id)
+        if rank != None:
+            summary += " Rating {}, ranked #{} of {}.".format(round(self.players.rating(sender_id)), rank, self.players.rated_count())
+        return summary
+
+    def leaderboard(self, n):
+        '''The n best rated players, at most 50'''
+        top = self.players.top(min(max(n, 1), 50))
+        if not top:
+            return "Nobody has played a rated game yet."
+        lines = ["Top {} players:".format(len(top))]
+        for pid, name, rating in top:
+            lines.append("#{} {} ({})".format(self.players.rank(pid), name, round(rating)))
+        return "\n".join(lines)
+
+    async def cmd_history(self, chat_id, sender_id, sender_username, args, match):
+        page = int(args[0]) if args and args[0].isdecimal() and int(args[0]) > 0 else 1
+        per_page = 5
+        total = self.archive.count(sender_id)
+        records = self.archive.recent(sender_id, (page - 1) * per_page, per_page)
+        if not records:
+            await self.reply(chat_id, "{} has no finished games{}.".format(sender_username, "" if total == 0 else " on that page"))
+            return
+        lines = ["{}'s finished games, page {} of {}:".format(sender_username, page, (total + per_page - 1) // per_page)]
+        for i, record in enumerate(records):
+            lines.append("{}. {} (W) versus {} (B), {} by {}, {} moves, {}".format((page - 1) * per_page + i + 1,
+                record["white"][1], record["black"][1], record["result"], record["termination"],
+                (len(unpack_moves(record["moves"])) + 1) // 2, time.strftime("%Y-%m-%d", time.gmtime(record["ended"]))))
+        lines.append("Use /pgn <number> to download a game.")
+        await self.reply(chat_id, "\n".join(lines))
+
+    async def cmd_pgn(self, chat_id, sender_id, sender_username, args, match):
+        n = int(args[0]) if args and args[0].isdecimal() else 0
+        records = self.archive.recent(sender_id, n - 1, 1) if n > 0 else []
+        if not records:
+            await self.reply(chat_id, "Incorrect usage. `Usage: /pgn <number>`, with a number from `/history`. E.g. `/pgn 1`", parse_mode='Markdown')
+            return
+        pgn = self.archive.pgn(records[0]).encode("utf-8")
+        self.outbox.send_document(chat_id, ("game{}.pgn".format(n), io.BytesIO(pgn)))
+
+    async def cmd_games(self, chat_id, sender_id, sender_username, args, match):
+        await self.reply(chat_id, self.games_summary(sender_id, sender_username))
+
+    async def cmd_stats(self, chat_id, sender_id, sender_username, args, match):
+        await self.reply(chat_id, self.stats_summary(sender_id, sender_username))
+
+    async def cmd_top(self, chat_id, sender_id, sender_username, args, match):
+        n = int(args[0]) if args and args[0].isdecimal() else 10
+        await self.reply(chat_id, self.leaderboard(n))
+
+    async def cmd_metrics(self, chat_id, sender_id, sender_username, args, match):
+        '''Counters and latencies, for admins only'''
+        if sender_id not in self.admins:
+            await self.reply(chat_id, "Only bot admins can view metrics.")
+            return
+        await self.reply(chat_id, METRICS.summary()[:TEXT_LIMIT] or "Nothing measured yet.")
 
-    def on_callback_query(self, msg):
+    async def on_callback_query(self, msg):
         '''Just logs the message. Does nothing for now'''
-        self.msglog.append(msg)
-        print(msg)
+        self.log_update("callback_query", msg)
 
-    def on_inline_query(self, msg):
+    async def on_inline_query(self, msg):
         '''Handles online queries by dynamically checking if it matches any keywords in the bank'''
-        self.msglog.append(msg)
-        print(msg)
+        self.log_update("inline_query", msg)
 
         query_id, from_id, query_string = telepot.glance(msg, flavor = "inline_query")
+        from_name = self.get_sender_details(msg)[1]
         def compute_answer():
-            bank = [{"type": "article", "id": "/start", "title": "/start", "description": "Starts the bot in this chat", "message_text": "/start"},
-                    {"type": "article", "id": "/help", "title": "/help", "description": "Displays help sheet for @tgchessbot", "message_text": "/help"},
-                    {"type": "article", "id": "/stats", "title": "/stats", "description": "Displays your match statistics with @tgchessbot", "message_text": "/stats"}]
-            ans = [opt for opt in bank if query_string in opt["id"]]
-            for opt in bank:
-                print(query_string, opt["id"], query_string in opt["id"])
-            return ans
+            # Message texts are only worked out for the entries that match, /games may read evicted matches from disk
+            bank = [("/start", "Starts the bot in this chat", lambda: "/start"),
+                    ("/help", "Displays help sheet for @tgchessbot", lambda: "/help"),
+                    ("/stats", "Displays your match statistics and rating with @tgchessbot", lambda: self.stats_summary(from_id, from_name)),
+                    ("/top", "Displays the rating leaderboard", lambda: self.leaderboard(10)),
+                    ("/games", "Lists your ongoing matches and whose turn it is", lambda: self.games_summary(from_id, from_name))]
+            return [{"type": "article", "id": id, "title": id, "description": description, "message_text": text()}
+                    for id, description, text in bank if query_string in id]
 
-        self._answerer.answer(msg, compute_answer)
+        # /stats and /games are personal, so the answer must not be cached for other users
+        await self.call(self.api.answerInlineQuery, query_id, compute_answer(), cache_time = 0, is_personal = True)
 
-    def on_chosen_inline_result(self, msg):
+    async def on_chosen_inline_result(self, msg):
         '''Just logs the message. Does nothing for now'''
-        self.msglog.append(msg)
-        print(msg)
+        self.log_update("chosen_inline_result", msg)
+
+    def pending(self):
+        '''Updates fed but not yet handled'''
+        return self.chats.pending()
+
+    def feed(self, update):
+        '''Route an update to its handler, queued behind earlier updates from the same chat (or user, outside chats)'''
+        if "message" in update:
+            msg = update["message"]
+            self.chats.submit(msg["chat"]["id"], self.on_chat_message, msg)
+        elif "callback_query" in update:
+            msg = update["callback_query"]
+            self.chats.submit(msg["from"]["id"], self.on_callback_query, msg)
+        elif "inline_query" in update:
+            msg = update["inline_query"]
+            self.chats.submit(msg["from"]["id"], self.on_inline_query, msg)
+        elif "chosen_inline_result" in update:
+            msg = update["chosen_inline_result"]
+            self.chats.submit(msg["from"]["id"], self.on_chosen_inline_result, msg)
+
+    async def poll_updates(self, timeout=20):
+        '''Long-poll getUpdates forever, handing each update to feed without waiting for it to be handled'''
+        offset = None
+        while 1:
+            try:
+                updates = await self.call(self.api.getUpdates, offset = offset, timeout = timeout)
+            except Exception as e:
+                log.warning("getUpdates failed: %r", e)
+                await asyncio.sleep(3)
+                continue
+            for update in updates:
+                offset = update["update_id"] + 1
+                self.feed(update)
+
+    def set_webhook(self, url, secret):
+        '''Have Telegram POST updates to url, signed with secret. telepot's setWebhook predates secret tokens'''
+        return self.api._api_request("setWebhook", {"url": url, "secret_token": secret,
+                                     "allowed_updates": json.dumps(["message", "callback_query", "inline_query", "chosen_inline_result"])})
+
+    async def run_forever(self, save_interval=1, poll_timeout=20, webhook=None, poll=True):
+        '''Handle updates and timers, flushing state to disk every save_interval seconds. load_state() must come first
+        Updates are long-polled, or received by webhook, a WebhookServer, if one is given. With poll=False and no
+        webhook, updates only come in through feed(), e.g. from a shard front.'''
+        log.info("Bot is online: %s", await self.call(self.api.getMe))
+        tasks = [asyncio.ensure_future(self.run_timers())]
+        compaction = None
+        if webhook is None and poll:
+            tasks.append(asyncio.ensure_future(self.poll_updates(poll_timeout)))
+        elif webhook is not None:
+            await webhook.start()
+        try:
+            while 1:
+                await asyncio.sleep(save_interval)
+                await self.flush_state() # Flush journal and messages periodically
+                if compaction is not None and compaction.done():
+                    if compaction.exception() is not None:
+                        log.error("Compaction failed", exc_info = compaction.exception())
+                    compaction = None
+                if compaction is None and self.compaction_due(time.time()):
+                    compaction = asyncio.ensure_future(self.compact())
+        finally:
+            for task in tasks + [compaction]:
+                if task is not None:
+                    task.cancel()
+            if webhook is not None:
+                webhook.stop()
+
+    def close(self):
+        '''Flush state and stop the worker pools'''
+        self.disk.shutdown() # Let queued writes finish first
+        self.save_state()
+        self.archive.close()
+        self.render_pool.shutdown()
+        self.engines.shutdown()
+        self.players.close()
+        self.api_pool.shutdown(wait = False)
 
 ############
 # AUTO RUN #
 ############
 telegram_bot_token = "<REMOVED>"
-bot = tgchessBot(telegram_bot_token)
-
-# For persistence
-if not os.path.exists("gamelog.txt"):
-    with open("gamelog.txt", "wb") as f:
-        pickle.dump({}, f)
-if not os.path.exists("msglog.txt"):
-    with open("msglog.txt", "wb") as f:
-        pickle.dump([], f)
-if not os.path.exists("statslog.txt"):
-    with open("statslog.txt", "wb") as f:
-        pickle.dump({}, f)
-bot.load_state()
-print("Previous state loaded.")
-
-# For server log
-print("Bot is online: ", bot.getMe())
-bot.message_loop()
-print("Listening...")
-
-# Keep the program running.
-while 1:
-    time.sleep(10)
-    bot.save_state() # Save state periodically
+api_url = None # Set to e.g. "http://localhost:8081" to go through a self-hosted Bot API server
+render_workers = 2 # Threads or processes drawing boards
+render_mode = 'thread' # 'thread' reuses per-match frames, 'process' sidesteps the GIL
+engine_workers = 2 # Processes searching for the built-in opponent
+engine_budget = 2.0 # Seconds the engine may think per move when it is not busy
+save_interval = 1 # Seconds between journal flushes, a crash loses at most this much
+match_ttl = 60 * 60 # Seconds before an idle match is moved out of memory into ./matches
+admin_ids = [] # Telegram user ids allowed to use /metrics
+metrics_port = None # Set to e.g. 9108 to serve Prometheus metrics on localhost
+webhook_url = None # Set to the public https URL Telegram should POST updates to, instead of polling for them...
+webhook_host, webhook_port = "127.0.0.1", 8443 # ... forwarded by a TLS reverse proxy to here
+webhook_secret = None # Token Telegram signs webhook requests with, a fresh random one each start if unset
+
+async def main(bot):
+    if metrics_port is not None:
+        await METRICS.serve(port = metrics_port)
+        log.info("Serving metrics on 127.0.0.1:%d", metrics_port)
+    webhook = None
+    if webhook_url:
+        secret = webhook_secret or secrets.token_urlsafe(32)
+        webhook = WebhookServer(bot, secret, webhook_host, webhook_port)
+        # Listen before Telegram starts sending
+        await webhook.start()
+        await bot.call(bot.set_webhook, webhook_url, secret)
+    else:
+        # getUpdates is refused while a webhook is set
+        await bot.call(bot.api.deleteWebhook)
+    log.info("Listening...")
+    # Keep the program running.
+    await bot.run_forever(save_interval, webhook = webhook)
+
+# Importing this module only defines the bot, see loadbench.py
+if __name__ == "__main__":
+    logging.basicConfig(level = logging.INFO, format = "%(asctime)s %(levelname)s %(name)s: %(message)s")
+    # Build the board images and piece tiles once, before any match needs them
+    get_assets()
+    log.info("Render assets loaded.")
+
+    api = BotAPI(telegram_bot_token, api_url) if api_url else None
+    bot = tgchessBot(telegram_bot_token, render_workers = render_workers, render_mode = render_mode, engine_workers = engine_workers,
+                     engine_budget = engine_budget, match_ttl = match_ttl, admins = admin_ids, api = api)
+
+    # For persistence
+    bot.load_state()
+    log.info("Previous state loaded.")
+
+    asyncio.run(main(bot))
@@ -0,0 +1,63 @@
+import heapq, itertools
+
+class TimerHeap():
+    '''One pending deadline per key, kept in a binary heap
+    Rescheduling or cancelling leaves the old heap entry behind and it is skipped when it surfaces,
+    so every operation is O(log n). The heap is rebuilt once stale entries outnumber live ones.'''
+    def __init__(self):
+        self.heap = [] # (when, tiebreak, key, kind)
+        self.timers = {} # key -> (when, kind, tiebreak) of its live entry
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return len(self.timers)
+
+    def __contains__(self, key):
+        return key in self.timers
+
+    def schedule(self, key, when, kind):
+        '''Fire (key, kind) at when, replacing any timer key already has'''
+        tiebreak = next(self.counter)
+        self.timers[key] = (when, kind, tiebreak)
+        heapq.heappush(self.heap, (when, tiebreak, key, kind))
+        if len(self.heap) > 2 * len(self.timers) + 64:
+            self.compact()
+
+    def cancel(self, key):
+        self.timers.pop(key, None)
+
+    def get(self, key):
+        '''(when, kind) of key's timer, or None'''
+        timer = self.timers.get(key)
+        return timer[:2] if timer else None
+
+    def live(self, entry):
+        timer = self.timers.get(entry[2])
+        return timer is not None and timer[2] == entry[1]
+
+    def next_deadline(self):
+        '''When the earliest timer is due, or None if there are none'''
+        while self.heap and not self.live(self.heap[0]):
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else None
+
+    def pop_due(self, now):
+        '''Remove and return [(key, kind)] of every timer due by now, earliest first'''
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            entry = heapq.heappop(self.heap)
+            if self.live(entry):
+                del self.timers[entry[2]]
+                due.append((entry[2], entry[3]))
+        return due
+
+    def compact(self):
+        self.heap = [(when, tiebreak, key, kind) for key, (when, kind, tiebreak) in self.timers.items()]
+        heapq.heapify(self.heap)
+
+    def dump(self):
+        return [[key, when, kind] for key, (when, kind, tiebreak) in self.timers.items()]
+
+    def restore(self, timers):
+        for key, when, kind in timers:
+            self.schedule(key, when, kind)
@@ -0,0 +1,121 @@
+import asyncio, hmac, json, logging
+from collections import deque
+from metrics import METRICS
+
+log = logging.getLogger("tgchessbot")
+
+SECRET_HEADER = "x-telegram-bot-api-secret-token"
+MAX_BODY = 1 << 20 # Bytes, far more than any update
+
+class WebhookServer():
+    '''Receives the updates Telegram POSTs to a webhook, instead of polling getUpdates for them
+    A request is checked against the secret token and acknowledged as soon as its update is queued; the
+    handlers see it afterwards through bot.feed(); bot is a tgchessBot or a ShardFront. The queue is bounded: while it is full, requests are refused
+    with a 503 and Telegram delivers them again later. Updates delivered twice are dropped by update_id.
+    Plain HTTP only, TLS is left to a reverse proxy in front.'''
+    def __init__(self, bot, secret, host="127.0.0.1", port=8443, path="/", queue_size=1000, max_pending=1000, remember=10000):
+        self.bot = bot
+        self.secret = secret.encode("utf-8") # Must match the secret_token given to setWebhook
+        self.host = host
+        self.port = port # 0 picks a free port
+        self.path = path
+        self.queue = asyncio.Queue(queue_size) # Updates acknowledged but not yet handed to the bot
+        self.max_pending = max_pending # Updates the bot may have in hand before the queue stops draining
+        self.remember = remember # update_ids kept for spotting redeliveries
+        self.seen = set()
+        self.seen_order = deque()
+        self.server = None
+        self.task = None
+        self.writers = set() # Open connections
+        METRICS.gauge("webhook_queued", lambda: self.queue.qsize())
+
+    async def start(self):
+        '''Start listening. Does nothing if already started'''
+        if self.server is not None:
+            return
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.task = asyncio.ensure_future(self.drain())
+        log.info("Receiving updates on http://%s:%d%s", self.host, self.port, self.path)
+
+    def stop(self):
+        '''Stop listening and hang up on open connections. Updates still queued are dropped, Telegram sends them again'''
+        if self.server is not None:
+            self.server.close()
+            self.task.cancel()
+            for writer in self.writers:
+                writer.close()
+
+    async def drain(self):
+        '''Hand queued updates to the bot, holding back while it is busy with max_pending of them'''
+        while 1:
+            update = await self.queue.get()
+            while self.bot.pending() >= self.max_pending:
+                await asyncio.sleep(0.01)
+            self.bot.feed(update)
+
+    async def handle(self, reader, writer):
+        '''Serve one connection. Telegram keeps connections open and sends requests on them one at a time'''
+        self.writers.add(writer)
+        try:
+            while 1:
+                request = await reader.readline()
+                if not request:
+                    break
+                parts = request.decode("latin-1").split()
+                headers = {}
+                while 1:
+                    line = (await reader.readline()).decode("latin-1")
+                    if line in ("\r\n", "\n", ""):
+                        break
+                    name, _, value = line.partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length") or 0)
+                if length > MAX_BODY:
+                    await respond(writer, 413, "Payload Too Large")
+                    break
+                body = await reader.readexactly(length)
+                status, reason = self.receive(parts, headers, body)
+                await respond(writer, status, reason)
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, ValueError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.writers.discard(writer)
+            writer.close()
+
+    def receive(self, parts, headers, body):
+        '''Queue the update in a request. Returns the HTTP status and reason to answer with'''
+        if len(parts) != 3 or parts[1].split("?")[0] != self.path:
+            return 404, "Not Found"
+        if parts[0] != "POST":
+            return 405, "Method Not Allowed"
+        if not hmac.compare_digest(headers.get(SECRET_HEADER, "").encode("utf-8"), self.secret):
+            METRICS.inc("webhook_requests_total", result = "forbidden")
+            return 403, "Forbidden"
+        try:
+            update = json.loads(body)
+            update_id = update["update_id"]
+        except (ValueError, TypeError, KeyError):
+            METRICS.inc("webhook_requests_total", result = "malformed")
+            return 400, "Bad Request"
+        if update_id in self.seen:
+            # Acknowledge it again, or Telegram keeps retrying
+            METRICS.inc("webhook_requests_total", result = "duplicate")
+            return 200, "OK"
+        try:
+            self.queue.put_nowait(update)
+        except asyncio.QueueFull:
+            METRICS.inc("webhook_requests_total", result = "refused")
+            return 503, "Service Unavailable"
+        self.seen.add(update_id)
+        self.seen_order.append(update_id)
+        if len(self.seen_order) > self.remember:
+            self.seen.discard(self.seen_order.popleft())
+        METRICS.inc("webhook_requests_total", result = "accepted")
+        return 200, "OK"
+
+async def respond(writer, status, reason):
+    writer.write("HTTP/1.1 {} {}\r\nContent-Length: 0\r\n\r\n".format(status, reason).encode("latin-1"))
+    await writer.drain()